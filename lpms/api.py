@@ -280,11 +280,14 @@ def resolve_dependencies(names, instruction):
             if instruction.command_line_options else []
     custom_options = instruction.custom_options \
             if instruction.custom_options else {}
+    config = conf.LPMSConfig()
     dependency_resolver = resolver.DependencyResolver(
             packages,
             command_line_options,
             custom_options,
-            instruction.use_new_options
+            instruction.use_new_options,
+            use_binary=instruction.use_binary or (hasattr(config, "use_binary_packages") \
+                    and config.use_binary_packages)
     )
     # To trigger resolver, call create_operation_plan
     return dependency_resolver.create_operation_plan()
@@ -296,7 +299,8 @@ def prepare_environment(package, instruction, **kwargs):
             options=kwargs.get("options", None),
             conditional_versions=kwargs.get("conditional_versions", None),
             conflicts=kwargs.get("conflicts", None),
-            inline_option_targets=kwargs.get("inline_option_targets", None)
+            inline_option_targets=kwargs.get("inline_option_targets", None),
+            binary_package=kwargs.get("binary_package", None)
     )
     return prepare.perform_operation()
 
@@ -16,94 +16,361 @@
 # along with lpms.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
-import time
+import re
+import bz2
 import gzip
+import shutil
+import hashlib
+import fnmatch
 import tarfile
 import zipfile
+import tempfile
+import threading
 import subprocess
 from collections import OrderedDict
 
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
 import lpms
 
 from lpms import out
+from lpms import conf
 from lpms import utils
+from lpms import treecache
+from lpms import constants as cst
+
+# Archives are never loaded into memory. Decompressed data flows
+# through a pipe in blocks of this size.
+chunk_size = 1024*1024
+
+# External decompressors for each compression type, in order of preference.
+# The parallel implementations come first, the reference tools are the last resort
+# before falling back to Python's own modules.
+decompressors = {
+        'gzip': (('pigz', '-dc'), ('gzip', '-dc')),
+        'bzip2': (('lbzip2', '-dc'), ('pbzip2', '-dc'), ('bzip2', '-dc')),
+        'xz': (('xz', '-T0', '-dc'),),
+        'lzma': (('xz', '--format=lzma', '-dc'), ('lzma', '-dc')),
+        'zstd': (('zstd', '-T0', '-dc'), ('zstd', '-dc')),
+        'lzip': (('plzip', '-dc'), ('lzip', '-dc')),
+}
+
+# Suffixes and the way to extract them. Longer suffixes must precede
+# the shorter ones because the first match wins.
+valid_types = OrderedDict([
+        ('tar.gz', ('extract_tar', 'gzip')),
+        ('tgz', ('extract_tar', 'gzip')),
+        ('tar.bz2', ('extract_tar', 'bzip2')),
+        ('tbz2', ('extract_tar', 'bzip2')),
+        ('tar.xz', ('extract_tar', 'xz')),
+        ('txz', ('extract_tar', 'xz')),
+        ('tar.lzma', ('extract_tar', 'lzma')),
+        ('tar.zst', ('extract_tar', 'zstd')),
+        ('tzst', ('extract_tar', 'zstd')),
+        ('tar.lz', ('extract_tar', 'lzip')),
+        ('tar', ('extract_tar', None)),
+        ('zip', ('extract_zip', None)),
+        ('lzma', ('extract_tar', 'lzma')),
+        ('xz', ('extract_tar', 'xz')),
+        ('gz', ('extract_gz', 'gzip')),
+])
+
+# Python modules that can decompress a stream if there is no external tool
+python_decompressors = {
+        'gzip': gzip.GzipFile,
+        'bzip2': bz2.BZ2File,
+}
+if lzma is not None:
+    python_decompressors['xz'] = lzma.LZMAFile
+    python_decompressors['lzma'] = lzma.LZMAFile
+
+# tarfile's own stream modes, used while unpacking a download without an external tool
+stream_modes = {
+        None: 'r|',
+        'gzip': 'r|gz',
+        'bzip2': 'r|bz2',
+}
+
+_decompressor_cache = {}
+
+glob_chars = re.compile(r"[*?[]")
+
+def get_decompressor(compression):
+    '''Returns the first available external command for the given compression type'''
+    if compression in _decompressor_cache:
+        return _decompressor_cache[compression]
+    command = None
+    for candidate in decompressors.get(compression, ()):
+        executable = utils.executable_path(candidate[0])
+        if executable is None:
+            continue
+        if candidate[0] == "xz" and "-T0" in candidate and not xz_supports_threads(executable):
+            command = (executable,)+tuple(item for item in candidate[1:] if item != "-T0")
+            break
+        command = (executable,)+candidate[1:]
+        break
+    _decompressor_cache[compression] = command
+    return command
+
+def xz_supports_threads(executable):
+    '''xz accepts -T since 5.2, older versions reject the option'''
+    with open(os.devnull, "w") as devnull:
+        return subprocess.call([executable, "-T0", "--version"], stdout=devnull, \
+                stderr=devnull) == 0
+
+def get_compression(path):
+    '''Returns the extraction method and the compression type of the given file'''
+    for file_type in valid_types:
+        if path.endswith(file_type):
+            return valid_types[file_type]
+    return None, None
+
+def partial_matcher(patterns):
+    '''Compiles partial extraction patterns into a single function.
+    A plain pattern selects every member whose name contains it, a pattern
+    with wildcards is matched against the whole name like a shell glob.'''
+    literals = []; globs = []
+    for pattern in patterns:
+        if glob_chars.search(pattern):
+            globs.append(fnmatch.translate(pattern))
+        else:
+            literals.append(re.escape(pattern))
+    literal = re.compile("|".join(literals)).search if literals else None
+    glob = re.compile("|".join(["(?:%s)" % item for item in globs])).match if globs else None
+    def matcher(name):
+        return (literal is not None and literal(name) is not None) or \
+                (glob is not None and glob(name) is not None)
+    return matcher
 
 class Archive:
     def __init__(self, location, partial):
         self.location = location
         self.partial = partial
-        
-    def extract_tar(self, path):
-        if not tarfile.is_tarfile(path):
-            out.error("%s is not a valid tar file." % path)
-            lpms.terminate()
+        config = conf.LPMSConfig()
+        self.parallel = config.parallel_decompression \
+                if hasattr(config, "parallel_decompression") else True
+
+    def open_stream(self, path, compression):
+        '''Opens a decompressed, forward-only stream of the given archive.
+        Returns the stream and the decompressor process if there is one.'''
+        command = get_decompressor(compression) if compression is not None \
+                and self.parallel else None
+        if command is not None:
+            # stderr goes to a file. A pipe that is never read may block the decompressor.
+            errors = tempfile.TemporaryFile()
+            process = subprocess.Popen(list(command)+[path], stdout=subprocess.PIPE, \
+                    stderr=errors, bufsize=chunk_size, close_fds=True)
+            process.errors = errors
+            process.killed = False
+            return process.stdout, process
+        if compression is None:
+            return open(path, "rb"), None
+        if compression in python_decompressors:
+            return python_decompressors[compression](path, "rb"), None
+        out.error("%s could not be extracted. please install one of these: %s" % \
+                (out.color(path, "red"), ", ".join([candidate[0] for candidate \
+                in decompressors[compression]])))
+        lpms.terminate()
 
-        archive = tarfile.open(path, 'r')
+    def close_stream(self, path, stream, process):
+        '''Closes the stream and waits for the decompressor. Calling it
+        again does nothing.'''
+        if not stream.closed:
+            stream.close()
+        if process is None or process.errors.closed:
+            return
+        try:
+            process.wait()
+            if process.returncode != 0 and not process.killed:
+                process.errors.seek(0)
+                out.error("could not extract: %s" % out.color(path, "red"))
+                out.write(process.errors.read())
+                lpms.terminate()
+        finally:
+            process.errors.close()
+
+    def extract_tar(self, path, compression=None):
+        matcher = None
         if isinstance(self.partial, list):
-            for name in archive.getnames():
-                if name in self.partial:
-                    archive.extract(name, path=self.location)
-                else:
-                    for partial in self.partial:
-                        if len(name.split(partial, 1)) == 2:
-                            archive.extract(name, path=self.location)
-        else:
-            archive.extractall(self.location)
-        archive.close()
+            matcher = partial_matcher(self.partial)
+
+        stream, process = self.open_stream(path, compression)
+        try:
+            archive = tarfile.open(fileobj=stream, mode='r|', bufsize=chunk_size)
+            if matcher is None:
+                archive.extractall(self.location)
+            else:
+                # Members are visited once, in archive order. The stream never seeks back.
+                for member in archive:
+                    if matcher(member.name):
+                        archive.extract(member, path=self.location)
+            archive.close()
+        except (tarfile.TarError, EOFError, IOError), err:
+            if process is not None and process.poll() is None:
+                # the error is reported here, not by close_stream
+                process.kill()
+                process.killed = True
+            out.error("%s is not a valid tar file: %s" % (out.color(path, "red"), err))
+            lpms.terminate()
+        finally:
+            self.close_stream(path, stream, process)
 
-    def extract_zip(self, path):
+    def extract_zip(self, path, compression=None):
         f = zipfile.ZipFile(path, "r")
         f.extractall(path=self.location)
         f.close()
 
-    def extract_lzma(self, path):
-        if not utils.executable_path("tar"):
-            lpms.terminate("please check app-arch/tar package")
-
-        current = os.getcwd()
-        os.chdir(self.location)
-        cmd = utils.executable_path("tar") + " --lzma xvf %s" % path
-        if path.endswith(".xz"):
-            cmd = utils.executable_path("tar") + " Jxvf %s" % path
-
-        stdout = subprocess.PIPE; stderr=subprocess.PIPE
-        result = subprocess.Popen(cmd, shell=True, stdout=stdout, stderr=stderr)
-        output, err = result.communicate()
-        if result.returncode != 0:
-            out.error("could not extract: %s" % out.color(path, "red"))
-            print(output+err)
-            os.chdir(current)
-            lpms.terminate()
-
-        os.chdir(current)
-
-    def extract_gz(self, path):
+    def extract_gz(self, path, compression=None):
         '''Extracts GZIP archives. It generally ships single files like
         a patch.
         '''
-        with gzip.open(path, "rb") as archive:
-            out.notify("extracting %s to %s" % (os.path.basename(path), self.location))
-            file_content = archive.read()
-            with open(os.path.join(self.location, 
-                "".join(os.path.basename(path).split(".gz"))), 
-                "w+") as myfile:
-                myfile.write(file_content)
-
-def extract(file_path, location, partial=False):
+        out.notify("extracting %s to %s" % (os.path.basename(path), self.location))
+        stream, process = self.open_stream(path, compression)
+        with open(os.path.join(self.location,
+            "".join(os.path.basename(path).split(".gz"))),
+            "wb") as myfile:
+            shutil.copyfileobj(stream, myfile, chunk_size)
+        self.close_stream(path, stream, process)
+
+class StreamExtractor(object):
+    '''Extracts a tar archive while its bytes are written in. It is used to
+    unpack the sources during the download.'''
+    def __init__(self, location, compression):
+        self.location = location
+        self.failed = False
+        self.process = None
+        command = get_decompressor(compression) if compression is not None else None
+        if command is not None:
+            self.errors = tempfile.TemporaryFile()
+            self.process = subprocess.Popen(list(command), stdin=subprocess.PIPE, \
+                    stdout=subprocess.PIPE, stderr=self.errors, close_fds=True)
+            self.writer, reader, mode = self.process.stdin, self.process.stdout, 'r|'
+        elif compression in stream_modes:
+            read_end, write_end = os.pipe()
+            self.writer = os.fdopen(write_end, "wb")
+            reader, mode = os.fdopen(read_end, "rb"), stream_modes[compression]
+        else:
+            raise ValueError("%s streams can not be extracted" % compression)
+        self.thread = threading.Thread(target=self.extract, args=(reader, mode))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def extract(self, reader, mode):
+        try:
+            try:
+                archive = tarfile.open(fileobj=reader, mode=mode, bufsize=chunk_size)
+                archive.extractall(self.location)
+                archive.close()
+                # consume the padding, the writer must never block on a full pipe
+                while reader.read(chunk_size):
+                    pass
+            except (tarfile.TarError, EOFError, IOError, OSError):
+                self.failed = True
+        finally:
+            reader.close()
+
+    def write(self, chunk):
+        if self.failed:
+            return
+        try:
+            self.writer.write(chunk)
+        except IOError:
+            self.failed = True
+
+    def finish(self):
+        '''Waits for the extraction, returns True if it is succeeded'''
+        try:
+            self.writer.close()
+        except IOError:
+            self.failed = True
+        self.thread.join()
+        if self.process is not None:
+            if self.process.wait() != 0:
+                self.failed = True
+            self.errors.close()
+        return not self.failed
+
+    def abort(self):
+        self.failed = True
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+        self.finish()
+
+def stream_extractor(filename, location):
+    '''Returns a StreamExtractor for the given archive name or None if
+    the archive type can not be extracted as a stream'''
+    method, compression = get_compression(filename)
+    if method != "extract_tar":
+        return None
+    if compression is not None and get_decompressor(compression) is None \
+            and compression not in stream_modes:
+        return None
+    return StreamExtractor(location, compression)
+
+def extract_cache(config=None):
+    '''Returns the cache of pristine extracted trees if it is enabled.
+    stream_extract keeps the trees that are unpacked during the download
+    there until the extract stage copies them.'''
+    if config is None:
+        config = conf.LPMSConfig()
+    if not (hasattr(config, "extract_cache") and config.extract_cache) and \
+            not (hasattr(config, "stream_extract") and config.stream_extract):
+        return None
+    return treecache.TreeCache(
+            config.extract_cache_dir if hasattr(config, "extract_cache_dir") \
+                    else cst.extract_cache,
+            config.extract_cache_size if hasattr(config, "extract_cache_size") \
+                    else cst.extract_cache_size,
+            config.extract_cache_mode if hasattr(config, "extract_cache_mode") \
+                    else "reflink")
+
+def cache_key(sha1, partial=False):
+    '''Cache entries are keyed by the archive content and the partial patterns'''
+    if isinstance(partial, list):
+        return sha1 + "-" + hashlib.sha1("\0".join(sorted(partial))).hexdigest()[:12]
+    return sha1
+
+def extract(file_path, location, partial=False, sha1=None):
+    '''sha1 is the checksum of the archive if it is known, the file is
+    not read again to find the key of its extracted tree.'''
     if not os.path.isfile(file_path):
         lpms.terminate("%s could not found!" % file_path)
-    valid_types = OrderedDict([
-            ('tar.bz2', 'extract_tar'),
-            ('tgz',  'extract_tar'),
-            ('zip', 'extract_zip'), 
-            ('lzma', 'extract_lzma'),
-            ('xz', 'extract_lzma'),
-            ('tar.gz', 'extract_tar'),
-            ('gz', 'extract_gz')
-    ])
 
-    churchkey = Archive(location, partial)
-    for file_type in valid_types:
-        if file_path.endswith(file_type):
-            getattr(churchkey, valid_types[file_type])(file_path)
+    method, compression = get_compression(file_path)
+    if method is None:
+        return
+
+    config = conf.LPMSConfig()
+    cache = extract_cache(config) if method != "extract_gz" else None
+    if cache is not None:
+        keep = hasattr(config, "extract_cache") and config.extract_cache
+        if sha1 is None:
+            sha1 = utils.sha1sum(file_path)
+        key = cache_key(sha1, partial)
+        if cache.lookup(key) is None and keep:
+            # An archive keeps one tree, the tree of the previous partial
+            # patterns is replaced instead of waiting for the eviction.
+            for other in cache.keys(sha1):
+                if other != key:
+                    cache.remove(other)
+            cache.store(key, lambda staging: getattr(Archive(staging, partial), \
+                    method)(file_path, compression))
+        elif cache.lookup(key) is not None:
+            out.notify("using the extracted tree of %s" % os.path.basename(file_path))
+        if cache.populate(key, location):
+            if not keep:
+                # the tree was unpacked during the download, it is used once
+                cache.remove(key)
             return
+        if not keep:
+            # the tree that was unpacked during the download has all of the members
+            cache.remove(sha1)
+
+    churchkey = Archive(location, partial)
+    getattr(churchkey, method)(file_path, compression)
@@ -0,0 +1,497 @@
+# Copyright 2009 - 2011 Burak Sezer <purak@hadronproject.org>
+#
+# This file is part of lpms
+#
+# lpms is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# lpms is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with lpms.  If not, see <http://www.gnu.org/licenses/>.
+
+# Binary packages. A binary package is a compressed tar stream:
+#
+#   METADATA        JSON object: the package, applied options, dependencies,
+#                   build info and the manifest of the image
+#   image/...       the install_dir of the build
+#
+# METADATA is the first member, so it can be read without decompressing
+# the image. The compression is detected from the magic bytes.
+#
+# A binary repository is a local directory or a static HTTP tree that has
+# the packages and an index.json file. The index lists the packages with
+# what decides whether they can be installed on a host: the applied
+# options, the machine, the compiler settings and the versions of the
+# build and runtime dependencies.
+
+import os
+import stat
+import json
+import time
+import errno
+import urllib2
+import hashlib
+import tarfile
+import subprocess
+import cStringIO
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+import lpms
+
+from lpms import out
+from lpms import conf
+from lpms import utils
+from lpms import archive
+from lpms import fetcher
+from lpms import constants as cst
+from lpms.exceptions import BinaryPackageError
+
+format_version = 1
+metadata_name = "METADATA"
+image_name = "image"
+
+# External compressors for each compression type, in order of preference
+compressors = {
+        'xz': (('xz', '-T0', '-c'), ('xz', '-c')),
+        'gzip': (('pigz', '-c'), ('gzip', '-c')),
+        'bzip2': (('lbzip2', '-c'), ('pbzip2', '-c'), ('bzip2', '-c')),
+        'zstd': (('zstd', '-T0', '-q', '-c'),),
+}
+
+# tarfile's own stream modes, used if there is no external compressor
+stream_modes = {
+        'gzip': 'w|gz',
+        'bzip2': 'w|bz2',
+}
+
+magic_numbers = (
+        ("\xfd7zXZ\x00", 'xz'),
+        ("\x1f\x8b", 'gzip'),
+        ("BZh", 'bzip2'),
+        ("\x28\xb5\x2f\xfd", 'zstd'),
+)
+
+def packages_dir(config=None):
+    if config is None:
+        config = conf.LPMSConfig()
+    return config.binary_packages_dir if hasattr(config, "binary_packages_dir") \
+            else cst.binary_packages
+
+def options_key(applied_options):
+    '''Packages that are built with different options are kept side by side'''
+    return hashlib.sha1(" ".join(sorted(applied_options or []))).hexdigest()[:10]
+
+def package_file(category, name, version, applied_options):
+    '''Returns the path of the package relative to the packages directory'''
+    return os.path.join(category, "%s-%s-%s%s" % (name, version, \
+            options_key(applied_options), cst.binary_suffix))
+
+def binary_repositories(config=None):
+    '''Returns the binary repositories, the local packages directory is the default'''
+    if config is None:
+        config = conf.LPMSConfig()
+    if hasattr(config, "binary_repositories") and config.binary_repositories:
+        return config.binary_repositories.split()
+    return [packages_dir(config)]
+
+def is_remote(repository):
+    return repository.split("://")[0] in ("http", "https", "ftp")
+
+def machine():
+    return os.uname()[4]
+
+def get_compressor(compression):
+    for candidate in compressors.get(compression, ()):
+        executable = utils.executable_path(candidate[0])
+        if executable is None:
+            continue
+        if candidate[0] == "xz" and "-T0" in candidate and \
+                not archive.xz_supports_threads(executable):
+            continue
+        return (executable,)+candidate[1:]
+    return None
+
+def get_compression(path):
+    with open(path, "rb") as myfile:
+        magic = myfile.read(6)
+    for number, compression in magic_numbers:
+        if magic.startswith(number):
+            return compression
+    return None
+
+def build_info():
+    '''Returns the build environment of the package'''
+    info = {"end_time": time.time()}
+    for key, variable in (("host", "HOST"), ("cflags", "CFLAGS"), ("cxxflags", "CXXFLAGS"), \
+            ("ldflags", "LDFLAGS"), ("jobs", "JOBS"), ("cc", "CC"), ("cxx", "CXX")):
+        info[key] = os.environ[variable] if variable in os.environ else ""
+    return info
+
+def build_profile(config=None):
+    '''Returns the compiler settings of the configuration. The environment
+    of the build is not used, so the packages that are created and the
+    host that installs them compare the same values.'''
+    if config is None:
+        config = conf.LPMSConfig()
+    profile = {}
+    for key, option in (("host", "CHOST"), ("cflags", "CFLAGS"), \
+            ("cxxflags", "CXXFLAGS"), ("ldflags", "LDFLAGS")):
+        profile[key] = getattr(config, option) if hasattr(config, option) else ""
+    return profile
+
+def hash_file(path):
+    return path, utils.sha1sum(path)
+
+def image_manifest(install_dir, jobs=None):
+    '''Returns the manifest of the image: path -> (type, ...). The
+    regular files are hashed in parallel.'''
+    manifest = {}; files = []
+    for parent, directories, names in os.walk(install_dir):
+        for name in directories + names:
+            path = os.path.join(parent, name)
+            info = os.lstat(path)
+            relative = path[len(install_dir):]
+            if stat.S_ISDIR(info.st_mode):
+                manifest[relative] = ("dir",)
+            elif stat.S_ISLNK(info.st_mode):
+                manifest[relative] = ("link", os.readlink(path))
+            elif stat.S_ISREG(info.st_mode):
+                manifest[relative] = ("file", None, info.st_size)
+                files.append(path)
+            else:
+                manifest[relative] = ("special",)
+    if files:
+        pool = ThreadPool(min(jobs or cpu_count(), len(files)))
+        try:
+            for path, sha1 in pool.imap_unordered(hash_file, files, 16):
+                relative = path[len(install_dir):]
+                manifest[relative] = ("file", sha1, manifest[relative][2])
+        finally:
+            pool.close()
+            pool.join()
+    return manifest
+
+def create(environment, directory=None, compression=None):
+    '''Archives the install_dir of the environment with its metadata.
+    Returns the path of the package.'''
+    config = conf.LPMSConfig()
+    if compression is None:
+        compression = config.binary_compression if hasattr(config, "binary_compression") \
+                else "xz"
+    path = os.path.join(directory or packages_dir(config), package_file(environment.category, \
+            environment.name, environment.version, environment.applied_options))
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    out.normal("creating binary package %s" % os.path.basename(path))
+    metadata = {
+            "format": format_version,
+            "repo": environment.repo,
+            "category": environment.category,
+            "name": environment.name,
+            "version": environment.version,
+            "slot": environment.slot,
+            "arch": machine(),
+            "applied_options": sorted(environment.applied_options) \
+                    if environment.applied_options is not None else None,
+            "dependencies": dict([(keyword, sorted([list(bundle) for bundle in bundles])) \
+                    for keyword, bundles in (environment.dependencies or {}).items()]),
+            "build_info": dict(build_info(), start_time=environment.start_time),
+            "profile": build_profile(config),
+            "manifest": image_manifest(environment.install_dir),
+    }
+    # The paths are byte strings, latin-1 keeps them as they are
+    data = json.dumps(metadata, sort_keys=True, encoding="latin-1")
+
+    # The package is written next to its target and renamed when it is complete
+    staging = path+".part"
+    target = open(staging, "wb")
+    command = get_compressor(compression)
+    process = None
+    if command is not None:
+        process = subprocess.Popen(list(command), stdin=subprocess.PIPE, stdout=target, \
+                close_fds=True)
+        stream, mode = process.stdin, "w|"
+    elif compression in stream_modes:
+        stream, mode = target, stream_modes[compression]
+    else:
+        out.warn("%s compressor could not be found, the package is not compressed." % compression)
+        stream, mode = target, "w|"
+    try:
+        try:
+            tar = tarfile.open(fileobj=stream, mode=mode, bufsize=archive.chunk_size)
+            info = tarfile.TarInfo(metadata_name)
+            info.size = len(data)
+            info.mtime = time.time()
+            tar.addfile(info, cStringIO.StringIO(data))
+            tar.add(environment.install_dir, arcname=image_name)
+            tar.close()
+        finally:
+            if process is not None:
+                process.stdin.close()
+                process.wait()
+            target.close()
+        if process is not None and process.returncode != 0:
+            raise BinaryPackageError("%s could not be compressed" % path)
+    except:
+        if os.path.exists(staging):
+            os.unlink(staging)
+        raise
+    os.rename(staging, path)
+    lpms.logger.info("binary package created: %s" % path)
+    add_to_index(directory or packages_dir(config), path, metadata)
+    return path
+
+def open_package(path):
+    '''Returns a tarfile that reads the package as a stream, and the
+    decompressor process if there is one'''
+    compression = get_compression(path)
+    stream, process = archive.Archive(os.path.dirname(path), False).open_stream(path, compression)
+    try:
+        return tarfile.open(fileobj=stream, mode="r|", bufsize=archive.chunk_size), stream, process
+    except tarfile.TarError, err:
+        close_package(stream, process)
+        raise BinaryPackageError("%s is not a valid binary package: %s" % (path, err))
+
+def close_package(stream, process):
+    '''Closes the stream, the decompressor may be stopped before the end'''
+    if process is not None and process.poll() is None:
+        process.kill()
+    stream.close()
+    if process is not None:
+        process.wait()
+        process.errors.close()
+
+def load_metadata(tar, path):
+    member = tar.next()
+    if member is None or member.name != metadata_name:
+        raise BinaryPackageError("%s has no metadata" % path)
+    try:
+        metadata = json.loads(tar.extractfile(member).read())
+    except ValueError, err:
+        raise BinaryPackageError("%s has broken metadata: %s" % (path, err))
+    if not isinstance(metadata, dict) or metadata.get("format") != format_version:
+        raise BinaryPackageError("%s has an unsupported format: %s" % \
+                (path, metadata.get("format") if isinstance(metadata, dict) else None))
+    metadata["manifest"] = dict([(relative.encode("latin-1"), entry) for relative, entry \
+            in metadata["manifest"].items()])
+    return metadata
+
+def read_metadata(path):
+    '''Reads the metadata without decompressing the image'''
+    tar, stream, process = open_package(path)
+    try:
+        return load_metadata(tar, path)
+    finally:
+        close_package(stream, process)
+
+def member_name(target, name, path):
+    '''Returns the normalised name of a member of the image. The members
+    must stay in target and must not be written through a symlink that
+    an earlier member has created.'''
+    normalised = os.path.normpath(name)
+    if os.path.isabs(name) or normalised == ".." or normalised.startswith("../"):
+        raise BinaryPackageError("%s has an unsafe member: %s" % (path, name))
+    parent = target
+    for part in normalised.split("/"):
+        parent = os.path.join(parent, part)
+        if os.path.islink(parent):
+            raise BinaryPackageError("%s has a member under a symlink: %s" % (path, name))
+    return normalised
+
+def extract(path, target):
+    '''Extracts the image of the package into target. The regular files are
+    checked against the manifest while they are written. Returns the metadata.'''
+    tar, stream, process = open_package(path)
+    try:
+        metadata = load_metadata(tar, path)
+        manifest = metadata["manifest"]
+        prefix = image_name+"/"
+        directories = []
+        for member in tar:
+            # the iteration starts over the members that are already read
+            if member.name in (metadata_name, image_name):
+                continue
+            if not member.name.startswith(prefix):
+                raise BinaryPackageError("%s has an unknown member: %s" % (path, member.name))
+            member.name = member_name(target, member.name[len(prefix):], path)
+            relative = "/"+member.name
+            if member.islnk():
+                if not member.linkname.startswith(prefix):
+                    raise BinaryPackageError("%s has an unknown link: %s" % (path, member.linkname))
+                member.linkname = member_name(target, member.linkname[len(prefix):], path)
+            if member.isdir():
+                # the attributes of the directories are set at the end,
+                # a read-only directory must not block its content
+                destination = os.path.join(target, member.name)
+                if not os.path.isdir(destination):
+                    os.makedirs(destination)
+                directories.append((member, destination))
+                continue
+            if not member.isreg():
+                tar.extract(member, path=target)
+                continue
+            expected = manifest.get(relative)
+            if expected is None or expected[0] != "file":
+                raise BinaryPackageError("%s is not in the manifest of %s" % (relative, path))
+            destination = os.path.join(target, member.name)
+            if not os.path.isdir(os.path.dirname(destination)):
+                os.makedirs(os.path.dirname(destination))
+            source = tar.extractfile(member)
+            sha1 = hashlib.sha1()
+            with open(destination, "wb") as myfile:
+                while True:
+                    data = source.read(archive.chunk_size)
+                    if not data:
+                        break
+                    sha1.update(data)
+                    myfile.write(data)
+            if sha1.hexdigest() != expected[1]:
+                raise BinaryPackageError("%s of %s is corrupted" % (relative, path))
+            tar.chown(member, destination)
+            tar.chmod(member, destination)
+            tar.utime(member, destination)
+        for member, destination in reversed(directories):
+            tar.chown(member, destination)
+            tar.utime(member, destination)
+            tar.chmod(member, destination)
+    except (tarfile.TarError, EOFError, IOError), err:
+        raise BinaryPackageError("%s could not be extracted: %s" % (path, err))
+    finally:
+        close_package(stream, process)
+    for relative, entry in manifest.items():
+        if not os.path.lexists(os.path.join(target, relative[1:])):
+            raise BinaryPackageError("%s of %s is missing" % (relative, path))
+    return metadata
+
+def index_entry(directory, path, metadata, sha1=None):
+    '''Returns the index entry of the package'''
+    dependencies = set()
+    for keyword, bundles in (metadata["dependencies"] or {}).items():
+        # conflicts and postmerge dependencies do not change the binaries
+        if keyword.endswith("_build") or keyword.endswith("_runtime"):
+            dependencies.update([tuple(bundle[:4]) for bundle in bundles])
+    return {
+            "file": os.path.relpath(path, directory),
+            "sha1": sha1 or utils.sha1sum(path),
+            "size": os.path.getsize(path),
+            "repo": metadata["repo"],
+            "category": metadata["category"],
+            "name": metadata["name"],
+            "version": metadata["version"],
+            "slot": metadata["slot"],
+            "arch": metadata.get("arch"),
+            "applied_options": metadata["applied_options"] or [],
+            "profile": metadata["profile"],
+            "dependencies": sorted([list(item) for item in dependencies]),
+    }
+
+def read_index(repository):
+    '''Returns the entries of the index of a binary repository'''
+    if is_remote(repository):
+        try:
+            data = urllib2.urlopen(repository.rstrip("/")+"/"+cst.binary_index).read()
+        except (urllib2.URLError, IOError), err:
+            out.warn("the index of %s could not be fetched: %s" % (repository, err))
+            return []
+    else:
+        try:
+            with open(os.path.join(repository, cst.binary_index)) as index:
+                data = index.read()
+        except IOError, err:
+            if err.errno != errno.ENOENT:
+                out.warn("the index of %s could not be read: %s" % (repository, err))
+            return []
+    try:
+        return json.loads(data)["packages"]
+    except (ValueError, KeyError):
+        out.warn("the index of %s is broken" % repository)
+        return []
+
+def write_index(directory, entries):
+    path = os.path.join(directory, cst.binary_index)
+    with open(path+".part", "w") as index:
+        json.dump({"format": format_version, "packages": sorted(entries, \
+                key=lambda entry: entry["file"])}, index, indent=1, sort_keys=True)
+    os.rename(path+".part", path)
+
+def add_to_index(directory, path, metadata, sha1=None):
+    '''Adds a package to the index of a local binary repository'''
+    entry = index_entry(directory, path, metadata, sha1)
+    entries = [item for item in read_index(directory) if item["file"] != entry["file"]]
+    entries.append(entry)
+    write_index(directory, entries)
+
+def update_index(directory):
+    '''Rebuilds the index of a local binary repository from its packages'''
+    entries = []
+    for parent, directories, files in os.walk(directory):
+        for name in sorted(files):
+            if not name.endswith(cst.binary_suffix):
+                continue
+            path = os.path.join(parent, name)
+            try:
+                entries.append(index_entry(directory, path, read_metadata(path)))
+            except BinaryPackageError, err:
+                out.warn(str(err))
+    write_index(directory, entries)
+    return entries
+
+def fetch(repository, entry):
+    '''Returns the local path of the package, remote packages are downloaded
+    to the packages directory. Returns None if it could not be fetched.'''
+    if not is_remote(repository):
+        path = os.path.join(repository, entry["file"])
+        return path if os.path.isfile(path) else None
+    directory = packages_dir()
+    path = os.path.join(directory, entry["file"])
+    if os.path.isfile(path) and utils.sha1sum(path) == entry["sha1"]:
+        return path
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    url = repository.rstrip("/")+"/"+entry["file"]
+    hashes = {os.path.basename(path): [entry["sha1"], str(entry["size"])]}
+    if not fetcher.URLFetcher().download(url, os.path.dirname(path), hashes=hashes):
+        return None
+    # the local repository serves it from now on
+    entries = [item for item in read_index(directory) if item["file"] != entry["file"]]
+    entries.append(entry)
+    write_index(directory, entries)
+    return path
+
+class BinaryIndex(object):
+    '''The binary packages of the binary repositories'''
+    def __init__(self, repositories=None):
+        if repositories is None:
+            repositories = binary_repositories()
+        self.arch = machine()
+        self.profile = build_profile()
+        self.packages = {}
+        for repository in repositories:
+            for entry in read_index(repository):
+                key = (entry["category"], entry["name"], entry["version"])
+                self.packages.setdefault(key, []).append((repository, entry))
+
+    def match(self, package, applied_options, versions):
+        '''Returns (repository, entry) of a package that can be installed instead of
+        building the package or None. versions is called with the category, name and
+        slot of a dependency and returns the version that is going to be installed.'''
+        options = sorted(applied_options or [])
+        for repository, entry in self.packages.get((package.category, package.name, \
+                package.version), []):
+            if entry["slot"] != package.slot or entry["applied_options"] != options:
+                continue
+            if entry["arch"] != self.arch or entry["profile"] != self.profile:
+                continue
+            for category, name, version, slot in entry["dependencies"]:
+                if versions(category, name, slot) != version:
+                    break
+            else:
+                return repository, entry
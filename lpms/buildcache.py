@@ -0,0 +1,128 @@
+# Copyright 2009 - 2011 Burak Sezer <purak@hadronproject.org>
+#
+# This file is part of lpms
+#
+# lpms is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# lpms is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with lpms.  If not, see <http://www.gnu.org/licenses/>.
+
+# The local cache of build results. The install_dir of a successful build
+# is kept under the fingerprint of everything that decides its content:
+# the spec, its libraries and files, the applied options, the compiler
+# settings and the versions of the build and runtime dependencies. A build with the
+# same fingerprint is restored from the cache instead of being compiled.
+
+import os
+import hashlib
+
+import lpms
+
+from lpms import out
+from lpms import conf
+from lpms import utils
+from lpms import binary
+from lpms import treecache
+from lpms import constants as cst
+
+# Changing the fingerprint invalidates the cached builds
+fingerprint_version = 2
+
+def build_cache(config=None):
+    '''Returns the build cache if it is enabled'''
+    if config is None:
+        config = conf.LPMSConfig()
+    if not (hasattr(config, "build_cache") and config.build_cache):
+        return None
+    return treecache.TreeCache(
+            config.build_cache_dir if hasattr(config, "build_cache_dir") \
+                    else cst.build_cache,
+            config.build_cache_size if hasattr(config, "build_cache_size") \
+                    else cst.build_cache_size,
+            config.build_cache_mode if hasattr(config, "build_cache_mode") \
+                    else "reflink")
+
+def library_files(environment):
+    '''Returns the paths of the build libraries that the spec uses'''
+    result = []
+    for library in environment.libraries or []:
+        if len(library.split("/")) == 2:
+            repo, name = library.split("/")
+        else:
+            repo, name = environment.repo, library
+        result.append(os.path.join(cst.repos, repo, "libraries", name+".py"))
+    return result
+
+def spec_files(environment):
+    '''Returns the spec, its libraries and the files directory of the package'''
+    result = [environment.spec_file] + library_files(environment)
+    if environment.filesdir is not None:
+        for parent, directories, files in os.walk(environment.filesdir):
+            directories.sort()
+            result.extend([os.path.join(parent, name) for name in sorted(files)])
+    return result
+
+def fingerprint(environment):
+    '''Returns the fingerprint of the build'''
+    sha1 = hashlib.sha1()
+    def add(item):
+        sha1.update(repr(item)+"\0")
+    add(fingerprint_version)
+    add((environment.repo, environment.category, environment.name, \
+            environment.version, environment.slot))
+    add(sorted(environment.applied_options or []))
+    add(binary.machine())
+    add(sorted(binary.build_profile().items()))
+    # the per package flags of the user change the environment of the build
+    for path in cst.local_env_variable_files:
+        add((path, utils.sha1sum(path) if os.path.isfile(path) else None))
+    for path in spec_files(environment):
+        add((path, utils.sha1sum(path) if os.path.isfile(path) else None))
+    dependencies = set()
+    for keyword, bundles in (environment.dependencies or {}).items():
+        # conflicts and postmerge dependencies do not change the build
+        if keyword.endswith("_build") or keyword.endswith("_runtime"):
+            dependencies.update([tuple(bundle[:4]) for bundle in bundles])
+    add(sorted(dependencies))
+    return sha1.hexdigest()
+
+def restore(cache, environment):
+    '''Copies the cached build into install_dir. Returns True on a hit.'''
+    environment.build_fingerprint = fingerprint(environment)
+    hit = cache.lookup(environment.build_fingerprint) is not None and \
+            cache.populate(environment.build_fingerprint, environment.install_dir)
+    cache.count(hit)
+    lpms.logger.info("build cache %s for %s/%s/%s-%s: %s" % ("hit" if hit else "miss", \
+            environment.repo, environment.category, environment.name, environment.version, \
+            environment.build_fingerprint))
+    return hit
+
+def store(cache, environment):
+    '''Saves the install_dir of a successful build'''
+    if environment.build_fingerprint is None:
+        return
+    out.notify("saving the build to the build cache")
+    def producer(staging):
+        error = treecache.copy_tree(environment.install_dir, staging)
+        if error is not None:
+            raise OSError(error)
+    try:
+        cache.store(environment.build_fingerprint, producer)
+    except OSError, err:
+        out.warn("the build could not be saved to the build cache: %s" % err)
+
+def show_statistics(cache):
+    stats = cache.statistics()
+    lookups = stats["hits"] + stats["misses"]
+    if not lookups:
+        return
+    out.normal("build cache: %d hits, %d misses (%.1f%% hit rate)" % (stats["hits"], \
+            stats["misses"], stats["hits"]*100.0/lookups))
@@ -0,0 +1,74 @@
+# Copyright 2009 - 2011 Burak Sezer <purak@hadronproject.org>
+#
+# This file is part of lpms
+#
+# lpms is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# lpms is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with lpms.  If not, see <http://www.gnu.org/licenses/>.
+
+# Resource accounting of the build stages. Every stage records its wall
+# time, the user and system CPU time of lpms and the processes it has
+# waited for, and the peak resident set size so far. They are kept in
+# environment.stage_stats and written to installdb with the package.
+#
+# The rusage values belong to the whole process. The stages that run in
+# worker threads, like the merges of the extra roots, record the CPU time
+# of their own thread instead; the processes that they wait for can not
+# be told apart and are not counted.
+
+import os
+import time
+import resource
+import threading
+from contextlib import contextmanager
+
+def thread_times():
+    '''Returns the user and system CPU time of the calling thread or None'''
+    try:
+        with open("/proc/thread-self/stat") as stat:
+            # the fields after the command name, utime and stime are the 14th and 15th
+            fields = stat.read().rsplit(")", 1)[1].split()
+    except (IOError, IndexError):
+        return None
+    ticks = float(os.sysconf("SC_CLK_TCK"))
+    return int(fields[11])/ticks, int(fields[12])/ticks
+
+def snapshot():
+    '''Returns the wall time, the CPU times and the peak RSS'''
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    max_rss = max(usage_self.ru_maxrss, usage_children.ru_maxrss)
+    if not isinstance(threading.current_thread(), threading._MainThread):
+        times = thread_times()
+        if times is not None:
+            return time.time(), times[0], times[1], max_rss
+    return time.time(), usage_self.ru_utime + usage_children.ru_utime, \
+            usage_self.ru_stime + usage_children.ru_stime, max_rss
+
+@contextmanager
+def measure(environment, stage):
+    '''Records the resources that the stage uses, even if it fails'''
+    start_time, start_user, start_system, start_rss = snapshot()
+    try:
+        yield
+    finally:
+        end_time, end_user, end_system, max_rss = snapshot()
+        if environment.stage_stats is None:
+            environment.stage_stats = []
+        environment.stage_stats.append((
+            stage,
+            end_time - start_time,
+            end_user - start_user,
+            end_system - start_system,
+            # in kilobytes, the kernel does not reset it between the stages
+            max_rss
+        ))
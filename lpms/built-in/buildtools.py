@@ -21,6 +21,7 @@ import subprocess
 import lpms
 from lpms import out
 from lpms import archive
+from lpms import fetcher
 from lpms import shelltools
 from lpms.exceptions import BuildError
 from lpms import conf as cfg
@@ -32,18 +33,21 @@ def standard_extract():
     Runs standard extract procedure
     """
     target = os.path.dirname(build_dir)
+    # The checksums are verified by the fetcher, the archives are not hashed again
+    hashes = fetcher.load_hashes(os.path.join(cst.repos, repo, category, name, "hashes"))
     for url in extract_plan:
         out.write("   %s %s\n" % (out.color(">", "green"), \
                 os.path.join(cfg.LPMSConfig().src_cache, \
                 os.path.basename(url))))
         archive_path = os.path.join(cfg.LPMSConfig().src_cache, \
                 os.path.basename(url))
+        sha1 = hashes[os.path.basename(url)][0] if os.path.basename(url) in hashes else None
         try:
             partial = [atom.strip() for atom in partial.split(" ")
                     if atom != "#"]
-            archive.extract(str(archive_path), str(target), partial)
+            archive.extract(str(archive_path), str(target), partial, sha1)
         except NameError:
-            archive.extract(str(archive_path), str(target))
+            archive.extract(str(archive_path), str(target), sha1=sha1)
 
 
 def standard_configure(*parameters):
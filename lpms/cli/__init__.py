@@ -73,6 +73,13 @@ class Actions(object):
         """
         self.instruction.new_root = self.argument_values["change_root"].strip()
 
+    def extra_roots(self):
+        """
+        Parses extra-roots argument
+        """
+        self.instruction.extra_roots = [root.strip() for root in \
+                self.argument_values["extra_roots"].split(",") if root.strip()]
+
     def parse_options(self):
         """
         Handles parse options
@@ -146,6 +153,22 @@ class CommandLineParser(Actions):
                         action='change_root', \
                         description='Changes installation target.'),
                 
+                AvailableArgument(arg='--extra-roots', \
+                        action='extra_roots', \
+                        description='Merges the built packages into these roots too, separated by commas.'),
+                
+                AvailableArgument(arg='--build-binary', \
+                        env_key='build_binary', \
+                        description='Creates binary packages of the built packages.'),
+                
+                AvailableArgument(arg='--use-binary', \
+                        env_key='use_binary', \
+                        description='Installs the packages from binary packages if they are available.'),
+                
+                AvailableArgument(arg='--image-build', \
+                        env_key='image_build', \
+                        description='Builds a fresh root: no collision checks, database indexes are created at the end.'),
+                
                 AvailableArgument(arg='--resume-build', \
                         env_key='resume_build', \
                         description='Resumes the most recent build operation.'),
@@ -232,6 +255,10 @@ class CommandLineParser(Actions):
                             env_key='build_info', \
                             description='Shows package\'s build information.'),
                     
+                    AvailableArgument(arg='--build-stats', \
+                            action='build_stats', \
+                            description='Shows the time and memory that the build stages of the packages used.'),
+                    
                     AvailableArgument(arg='--clean-system', \
                             action='clean_system', \
                             description='Removes unneeded packages from the system.'),
@@ -273,6 +300,7 @@ class CommandLineParser(Actions):
                 'update': ('upgrade'),
                 'upgrade': [],
                 'change_root': None,
+                'extra_roots': None,
                 'parse_options': None,
         }
 
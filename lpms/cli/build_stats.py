@@ -0,0 +1,99 @@
+# Copyright 2009 - 2012 Burak Sezer <purak@hadronproject.org>
+#
+# This file is part of lpms
+#
+# lpms is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# lpms is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with lpms.  If not, see <http://www.gnu.org/licenses/>.
+
+import lpms
+
+from lpms import out
+from lpms.db import api
+
+class BuildStats(object):
+    '''Shows the time, CPU and memory that the stages of the builds used'''
+    def __init__(self, packages):
+        self.packages = packages
+        self.instdb = api.InstallDB()
+
+    def format_rss(self, kilobytes):
+        if kilobytes >= 1024*1024:
+            return "%.1fG" % (kilobytes/(1024.0*1024))
+        if kilobytes >= 1024:
+            return "%.1fM" % (kilobytes/1024.0)
+        return "%dK" % kilobytes
+
+    def show_stats(self, package):
+        items = self.instdb.database.get_build_stats(package.id)
+        out.normal("Build statistics for %s/%s/%s-%s {%s:%s}" % (package.repo, \
+                package.category, package.name, package.version, package.slot, package.arch))
+        if not items:
+            out.write("no build statistics recorded.\n")
+            return
+        dominant = max(items, key=lambda item: item[1])
+        out.write("%-14s %10s %10s %10s %10s\n" % ("Stage", "Wall", "User", "System", "Peak RSS"))
+        for stage, wall_time, user_time, system_time, max_rss in items:
+            line = "%-14s %9.1fs %9.1fs %9.1fs %10s" % (stage, wall_time, user_time, \
+                    system_time, self.format_rss(max_rss))
+            if stage == dominant[0]:
+                line = out.color(line, "brightyellow")
+            out.write(line+"\n")
+        out.write("%-14s %9.1fs %9.1fs %9.1fs %10s\n" % ("Total", \
+                sum([item[1] for item in items]), sum([item[2] for item in items]), \
+                sum([item[3] for item in items]), self.format_rss(max([item[4] for item in items]))))
+
+    def show_longest(self, count=20):
+        '''Shows the installed packages that took the longest time to build'''
+        packages = {}
+        for item in self.instdb.database.get_all_build_stats():
+            package, stage, wall_time = "/".join(item[:3])+"-"+item[3], item[4], item[5]
+            total, longest = packages.get(package, (0, None))
+            if longest is None or wall_time > longest[1]:
+                longest = (stage, wall_time)
+            packages[package] = (total+wall_time, longest)
+        if not packages:
+            out.write("no build statistics recorded.\n")
+            return
+        out.normal("The longest builds")
+        ordered = sorted(packages.items(), key=lambda item: item[1][0], reverse=True)
+        for package, (total, longest) in ordered[:count]:
+            out.write("%9.1fs  %s (%s: %.1fs)\n" % (total, out.color(package, "green"), \
+                    longest[0], longest[1]))
+
+    def run(self):
+        if not self.packages:
+            self.show_longest()
+            return
+
+        for name in self.packages:
+            package = name.split("/")
+            if len(package) == 3:
+                myrepo, mycategory, myname = package
+                packages = self.instdb.find_package(package_name=myname, \
+                        package_repo=myrepo, package_category=mycategory)
+            elif len(package) == 2:
+                mycategory, myname = package
+                packages = self.instdb.find_package(package_name=myname, \
+                        package_category=mycategory)
+            elif len(package) == 1:
+                packages = self.instdb.find_package(package_name=package[0])
+            else:
+                out.error("%s seems invalid." % out.color(name, "brightred"))
+                lpms.terminate()
+
+            if not packages:
+                out.error("%s not found!" % out.color(name, "brightred"))
+                lpms.terminate()
+
+            for package in packages:
+                self.show_stats(package)
@@ -17,6 +17,9 @@
 
 import os
 import glob
+import collections
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import xml.etree.cElementTree as iks
 
 import lpms
@@ -24,17 +27,21 @@ from lpms import out
 from lpms import conf
 from lpms import utils
 from lpms import fetcher
-from lpms import shelltools
 from lpms import constants as cst
 
 app_name = "lhashgen"
-app_version = "0.1"
+app_version = "0.2"
 
 class Generate(object):
-    def __init__(self, current_dir, files):
+    # the files of the package directory that are not hashed
+    excepts = ('hashes',)
+
+    def __init__(self, current_dir, files, jobs=None):
         self.current_dir = current_dir
+        self.src_cache = conf.LPMSConfig().src_cache
         self.repo_path = None
         self.files = files
+        self.jobs = jobs if jobs else cpu_count()
 
     def parse_categories(self):
         for i in iks.iterparse(os.path.join(self.repo_path, cst.repo_info, cst.categories)):
@@ -59,56 +66,142 @@ class Generate(object):
         if len(specs) == 0:
             lpms.terminate("there are no spec file in %s." % self.current_dir)
 
-    def calculate_hashes(self):
-        def write_archive_hash(urls, file_name):
-            name, version = utils.parse_pkgname(file_name)
-            for url in utils.parse_url_tag(urls, name, version):
-                archive_name = os.path.basename(url)
-                archive_path = os.path.join(conf.LPMSConfig().src_cache, archive_name)
-                if not os.access(archive_path, os.F_OK):
-                    fetcher.URLFetcher().run([url])
-                sha1 = utils.sha1sum(archive_path)
-                shelltools.echo("hashes", "%s %s %s" % (archive_name, sha1, os.path.getsize(archive_path)))
-
-        excepts = ('hashes')
-        shelltools.remove_file("hashes")
-        if len(self.files) == 0:
-            self.files = os.listdir(self.current_dir)
-
-        for f in self.files:
-            if f in excepts:
+    def check_repository(self):
+        self.repo_path = self.current_dir
+        repo_file = os.path.join(self.repo_path, cst.repo_file)
+        if not os.path.isfile(repo_file):
+            lpms.terminate("%s not found!" % repo_file)
+
+    def archive_urls(self, spec_path):
+        '''Returns the archive urls of the given spec'''
+        content = utils.import_script(spec_path)
+        metadata = utils.metadata_parser(content["metadata"])
+        if "src_url" in metadata.keys():
+            urls = metadata["src_url"]
+        elif "src_url" in content.keys():
+            urls = content["src_url"]
+        else:
+            lpms.terminate("src_url was not defined in %s" % spec_path)
+        name, version = utils.parse_pkgname(os.path.basename(spec_path)[:-len(cst.spec_suffix)])
+        return utils.parse_url_tag(urls, name, version)
+
+    def package_entries(self, package_dir, files):
+        '''Returns (name, path) pairs of the files that are listed in the
+        hashes file of the package and the archives that must be fetched'''
+        entries = []; missing = []
+        if not files:
+            files = sorted(os.listdir(package_dir))
+        for f in files:
+            if f in self.excepts:
                 continue
+            path = os.path.join(package_dir, f)
             if f.endswith(cst.spec_suffix):
-                out.normal("processing %s" % f)
-                shelltools.echo("hashes", "%s %s %s" % (f, utils.sha1sum(f), os.path.getsize(f)))
-                content = utils.import_script(f)
-                if "src_url" in utils.metadata_parser(content["metadata"]).keys():
-                    write_archive_hash(utils.metadata_parser(content["metadata"])["src_url"], f)
-                elif "src_url" in content.keys():
-                    write_archive_hash(content["src_url"], f)
-                else:
-                    lpms.terminate("src_url was not defined in spec")
-                del content
-            elif os.path.isdir(f):
-                for l in os.listdir(os.path.join(self.current_dir, f)):
-                    path = os.path.join(f, l)
-                    out.normal("processing %s" % path)
-                    shelltools.echo("hashes", "%s %s %s" %  (path, utils.sha1sum(path), os.path.getsize(path)))
+                entries.append((f, path))
+                for url in self.archive_urls(path):
+                    archive_name = os.path.basename(url)
+                    archive_path = os.path.join(self.src_cache, archive_name)
+                    if not os.access(archive_path, os.F_OK) and not url in missing:
+                        missing.append(url)
+                    entries.append((archive_name, archive_path))
+            elif os.path.isdir(path):
+                for l in sorted(os.listdir(path)):
+                    # only regular files can be hashed
+                    if os.path.isfile(os.path.join(path, l)):
+                        entries.append((os.path.join(f, l), os.path.join(path, l)))
+        return entries, missing
+
+    def generate(self, packages):
+        '''Writes hashes files of the given (package directory, files) pairs.
+        The files of all packages are hashed by a pool of workers.'''
+        jobs = []; missing = []
+        for package_dir, files in packages:
+            out.normal("processing %s" % os.path.relpath(package_dir, self.repo_path))
+            entries, urls = self.package_entries(package_dir, files)
+            jobs.extend([(package_dir, name, path) for name, path in entries])
+            missing.extend([url for url in urls if not url in missing])
+
+        # The fetcher changes the working directory and draws its progress,
+        # the archives are fetched one by one.
+        if missing:
+            out.normal("fetching %d archive(s)" % len(missing))
+            for url in missing:
+                if not fetch(url):
+                    lpms.terminate("some archives could not be fetched")
+
+        pool = ThreadPool(self.jobs)
+        try:
+            results = pool.map(calculate, [path for package_dir, name, path in jobs])
+        finally:
+            pool.close()
+            pool.join()
+
+        hashes = collections.OrderedDict()
+        for (package_dir, name, path), result in zip(jobs, results):
+            hashes.setdefault(package_dir, []).append(format_entry(name, result))
+        for package_dir, lines in hashes.items():
+            with open(os.path.join(package_dir, "hashes"), "w") as hashes_file:
+                hashes_file.write("\n".join(lines)+"\n")
+
+    def calculate_hashes(self):
+        self.generate([(self.current_dir, self.files)])
+
+    def calculate_repository(self):
+        '''Regenerates the hashes files of every package in the repository'''
+        packages = []
+        for category in self.parse_categories():
+            category_dir = os.path.join(self.repo_path, category)
+            if not os.path.isdir(category_dir):
+                continue
+            for name in sorted(os.listdir(category_dir)):
+                package_dir = os.path.join(category_dir, name)
+                if glob.glob(os.path.join(package_dir, "*"+cst.spec_suffix)):
+                    packages.append((package_dir, []))
+        self.generate(packages)
+
+def fetch(url):
+    return fetcher.URLFetcher().run([url])
+
+def calculate(path):
+    return utils.file_digests(path)
 
+def format_entry(name, result):
+    '''The first three fields are the name, sha1sum and size of the file
+    as before. Other digests are appended as algorithm:digest fields.'''
+    size, digests = result
+    return " ".join([name, digests[0][1], str(size)]+ \
+            ["%s:%s" % digest for digest in digests[1:]])
 
 def usage():
     out.normal("A tool that creates \'hashes\' file for lpms packages.")
     out.green("General Usage:\n")
     out.write(" $ lhashgen <spec name>\n")
     out.write("\nIf you do not give any package name with command, it scans the directory and operates all valid specs\n")
+    out.write("\nUse \'--repository\' in the root of a repository to regenerate all of its hashes files\n")
+    out.write("Use \'--jobs=N\' to set the number of workers, the default is the number of processors\n")
     out.write("\nUse \'--version\' to see program's version\n")
     lpms.terminate()
 
 def main(files):
-    opr = Generate(os.getcwd(), files)
+    jobs = None
+    for arg in files[:]:
+        if arg.startswith("--jobs"):
+            try:
+                jobs = int(arg.split("=", 1)[1])
+            except (IndexError, ValueError):
+                jobs = 0
+            if jobs <= 0:
+                out.error("%s is invalid, the number of workers must be a positive integer." % \
+                        out.color(arg, "brightred"))
+                lpms.terminate()
+            files.remove(arg)
+    opr = Generate(os.getcwd(), files, jobs)
     if "--help" in files:
         usage()
     elif "--version" in files:
         out.write("%s-%s\n" % (app_name, app_version))
+    elif "--repository" in files:
+        opr.check_repository()
+        opr.calculate_repository()
+        return
     opr.check_repo_dir()
     opr.calculate_hashes()
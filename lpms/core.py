@@ -17,6 +17,8 @@
 
 import os
 import sys
+import copy
+from multiprocessing.pool import ThreadPool
 
 # TODO: logging
 import lpms
@@ -24,14 +26,23 @@ import lpms
 from lpms import out
 from lpms import api
 from lpms.db import api as dbapi
+from lpms.db import base as dbbase
 from lpms import conf
+from lpms import internals
 from lpms import utils
+from lpms import binary
+from lpms import buildcache
+from lpms import schedule
+from lpms import journal
+from lpms import triggers
 from lpms import shelltools
+from lpms import constants as cst
 from lpms.utils import showplan
 from lpms.operations import merge
 from lpms import interpreter
 from lpms import file_collisions
 from lpms.cli import CommandLineParser
+from lpms.cli import build_stats
 from lpms.exceptions import PackageNotFound, LpmsTerminate
 
 # The core of lpms package manager.
@@ -48,8 +59,33 @@ class Operations(object):
             return method(*args, **kwargs)
         return wrapper
 
+    def recover_merges(self):
+        '''Completes or rolls back the merges that were interrupted. Only the
+        operations that change the roots call it.'''
+        if self.request.instruction.pretend:
+            return
+        journal.recover(self.request.instruction.new_root \
+                if self.request.instruction.new_root else cst.root)
+        for root in self.request.instruction.extra_roots or []:
+            journal.recover(root)
+
+    def check_image_roots(self):
+        '''--image-build skips the collision checks and the durability of the
+        databases, so it is only allowed for roots that have no packages'''
+        try:
+            for root in [None]+list(self.request.instruction.extra_roots or []):
+                dbbase.use_root(root)
+                if dbapi.InstallDB().database.get_all_packages():
+                    out.error("--image-build needs a fresh root, %s has installed packages." % \
+                            (root if root is not None else self.request.instruction.new_root \
+                            if self.request.instruction.new_root else cst.root))
+                    raise LpmsTerminate
+        finally:
+            dbbase.use_root(None)
+
     @check_root
     def remove(self):
+        self.recover_merges()
         try:
             api.remove_package(self.request.names, self.request.instruction)
         except PackageNotFound as err:
@@ -72,11 +108,75 @@ class Operations(object):
     def sync(self):
         api.syncronization(self.request.names)
 
+    def build_stats(self):
+        build_stats.BuildStats(self.request.names).run()
+
+    def create_binary_package(self, environment):
+        '''Archives the built package. The image is prepared for the merge
+        first, so the binary package has the files that are merged.'''
+        image = merge.Merge(environment)
+        image.create_info_archive()
+        image.strip_binaries()
+        environment.not_strip = True
+        binary.create(environment)
+
+    def merge_roots(self, environment, collision_check):
+        '''Merges the built package into the root and the extra roots in parallel.
+        Every root has its own databases, the repository database is shared.'''
+        # The binaries are stripped once, the roots get copies of the stripped tree
+        merge.Merge(environment).strip_binaries()
+        environment.not_strip = True
+        environments = [(environment, None)]
+        for index, root in enumerate(self.request.instruction.extra_roots, 1):
+            root_environment = internals.Environment()
+            root_environment.raw.update(environment.raw)
+            # write_db modifies these objects
+            root_environment.package = copy.copy(environment.package)
+            root_environment.conditional_versions = copy.deepcopy(environment.conditional_versions)
+            root_environment.stage_stats = list(environment.stage_stats or [])
+            root_environment.real_root = root
+            root_environment.install_dir = environment.install_dir+".root%d" % index
+            merge.copy_tree(environment.install_dir, root_environment.install_dir)
+            environments.append((root_environment, root))
+
+        def merge_root(item):
+            root_environment, root = item
+            dbbase.use_root(root)
+            try:
+                if root is not None:
+                    # The version that is replaced comes from the installdb of this root
+                    installed_package = dbapi.InstallDB().find_package(
+                            package_name=root_environment.name,
+                            package_category=root_environment.category,
+                            package_slot=root_environment.slot)
+                    root_environment.previous_version = installed_package.get(0).version \
+                            if installed_package else None
+                if not collision_check(root_environment):
+                    out.error("file collisions detected in %s, the package is not merged there." % \
+                            root_environment.real_root)
+                    return False
+                return merge.Merge(root_environment).perform_operation()[0]
+            finally:
+                dbbase.use_root(None)
+                if root is not None:
+                    shelltools.remove_dir(root_environment.install_dir)
+
+        pool = ThreadPool(len(environments))
+        try:
+            results = pool.map(merge_root, environments)
+        finally:
+            pool.close()
+            pool.join()
+        return all(results), environment
+
     @check_root
     def package_mangler(self, **kwargs):
-        def collision_check():
+        def collision_check(environment):
             # TODO: This is a temporary solution. collision_check function 
             # must be a reusable part for using in remove operation
+            if environment.image_build:
+                # Only the packages of the plan are merged into a fresh root
+                return True
             out.normal("checking file collisions...")
             lpms.logger.info("checking file collisions")
             collision_object = file_collisions.CollisionProtect(
@@ -111,25 +211,39 @@ class Operations(object):
                     return False
             return True
 
+        self.recover_merges()
+        if self.request.instruction.image_build:
+            self.check_image_roots()
         names = kwargs.get("names", self.request.names)
         # Prepare build environment
         out.normal("resolving dependencies")
         targets = api.resolve_dependencies(names, self.request.instruction)
+        # Start the longest chains of builds first
+        estimates = schedule.BuildHistory(dbapi.InstallDB(), \
+                targets.binaries).estimates(targets.packages)
+        if targets.package_query is not None:
+            targets.packages = schedule.order(targets.packages, targets.package_query, estimates)
         if self.request.instruction.pretend:
             out.write("\n")
             out.normal("these packages will be merged, respectively:\n")
-            showplan.show(targets.packages, targets.conflicts, targets.options, installdb=dbapi.InstallDB())
-            out.write("\ntotal %s package(s) listed.\n\n" \
+            showplan.show(targets.packages, targets.conflicts, targets.options, installdb=dbapi.InstallDB(), \
+                    binaries=targets.binaries or None, estimates=estimates)
+            out.write("\ntotal %s package(s) listed.\n" \
                     % out.color(str(len(targets.packages)), "green"))
+            showplan.show_estimate(targets.packages, estimates)
+            out.write("\n")
             raise LpmsTerminate
 
         if self.request.instruction.ask:
             out.write("\n")
             out.normal("these packages will be merged, respectively:\n")
-            showplan.show(targets.packages, targets.conflicts, targets.options, installdb=dbapi.InstallDB())
+            showplan.show(targets.packages, targets.conflicts, targets.options, installdb=dbapi.InstallDB(), \
+                    binaries=targets.binaries or None, estimates=estimates)
             utils.xterm_title("lpms: confirmation request")
-            out.write("\ntotal %s package(s) will be merged.\n\n" \
+            out.write("\ntotal %s package(s) will be merged.\n" \
                     % out.color(str(len(targets.packages)), "green"))
+            showplan.show_estimate(targets.packages, estimates)
+            out.write("\n")
 
             if not utils.confirm("Would you like to continue?"):
                 # Reset terminal title and terminate lpms.
@@ -137,68 +251,104 @@ class Operations(object):
                 raise LpmsTerminate
 
         self.request.instruction.count = len(targets.packages)
-        for index, package in enumerate(targets.packages, 1):
-            self.request.instruction.index = index
-            retval, environment = api.prepare_environment(
-                    package,
-                    self.request.instruction,
-                    dependencies=targets.dependencies[package.id] if package.id in \
-                            targets.dependencies else None,
-                    options=targets.options[package.id] if package.id in \
-                            targets.options else None,
-                    conditional_versions=targets.conditional_versions[package.id] \
-                            if package.id in targets.conditional_versions else None,
-                    conflicts=targets.conflicts[package.id] if package.id \
-                            in targets.conflicts else None,
-                    inline_option_targets=targets.inline_option_targets[package.id] \
-                            if package.id in targets.inline_option_targets else None
-            )
-            if not retval:
-                out.error("There are some errors while preparing environment to build FOO.")
-                out.error("So you should submit a bug report to fix the issue.")
-                raise LpmsTerminate("thanks to flying with lpms.")
-            # Now, run package script(spec) for configuring, building and install
-            retval, environment = self.interpreter.initialize(environment)
-            if retval is False:
-                out.error("There are some errors while building FOO from source.")
-                out.error("Error messages should be seen above.")
-                out.error("If you want to submit a bug report, please attatch BAR or send above messages in a proper way.")
-                raise LpmsTerminate("thanks to flying with lpms.")
-            elif retval is None:
-                raise LpmsTerminate
+        if self.request.instruction.image_build:
+            out.normal("building an image, database indexes are created at the end")
+            dbapi.FilesDB().drop_indexes()
+        build_cache = buildcache.build_cache(self.config)
+        try:
+            for index, package in enumerate(targets.packages, 1):
+                self.request.instruction.index = index
+                retval, environment = api.prepare_environment(
+                        package,
+                        self.request.instruction,
+                        dependencies=targets.dependencies,
+                        options=targets.options,
+                        conditional_versions=targets.conditional_versions[package.id] \
+                                if package.id in targets.conditional_versions else None,
+                        conflicts=targets.conflicts[package.id] if package.id \
+                                in targets.conflicts else None,
+                        inline_option_targets=targets.inline_option_targets[package.id] \
+                                if package.id in targets.inline_option_targets else None,
+                        binary_package=targets.binaries.get(package.id) \
+                                if targets.binaries else None
+                )
+                if not retval:
+                    out.error("There are some errors while preparing environment to build FOO.")
+                    out.error("So you should submit a bug report to fix the issue.")
+                    raise LpmsTerminate("thanks to flying with lpms.")
+                # Now, run package script(spec) for configuring, building and install
+                retval, environment = self.interpreter.initialize(environment)
+                if retval is False:
+                    out.error("There are some errors while building FOO from source.")
+                    out.error("Error messages should be seen above.")
+                    out.error("If you want to submit a bug report, please attatch BAR or send above messages in a proper way.")
+                    raise LpmsTerminate("thanks to flying with lpms.")
+                elif retval is None:
+                    raise LpmsTerminate
 
-            if not collision_check():
-                out.error("File collisions detected. If you want to overwrite these files,")
-                out.error("You have to use --force-file-collisions parameter or disable collision_protect in configuration file.")
-                raise LpmsTerminate("thanks to flying with lpms.")
-            
-            # Merge package to livefs
-            if environment.not_merge:
-                raise LpmsTerminate("not merging...")
-            retval, environment = merge.Merge(environment).perform_operation()
-            if not retval:
-                raise LpmsTerminate("Some errors occured while merging %s" % environment.fullname)
+                # Save the build before it is stripped and merged
+                if not environment.prebuilt and build_cache is not None:
+                    buildcache.store(build_cache, environment)
+
+                # Keep the build as a binary package, other hosts can install it without building
+                if environment.binary_package is None and (environment.build_binary or \
+                        (hasattr(self.config, "build_binary_packages") and \
+                        self.config.build_binary_packages)):
+                    self.create_binary_package(environment)
+
+                if self.request.instruction.extra_roots:
+                    if environment.not_merge:
+                        raise LpmsTerminate("not merging...")
+                    # The same build is merged into every root
+                    retval, environment = self.merge_roots(environment, collision_check)
+                    if not retval:
+                        raise LpmsTerminate("Some errors occured while merging %s" % environment.fullname)
+                else:
+                    if not collision_check(environment):
+                        out.error("File collisions detected. If you want to overwrite these files,")
+                        out.error("You have to use --force-file-collisions parameter or disable collision_protect in configuration file.")
+                        raise LpmsTerminate("thanks to flying with lpms.")
+
+                    # Merge package to livefs
+                    if environment.not_merge:
+                        raise LpmsTerminate("not merging...")
+                    retval, environment = merge.Merge(environment).perform_operation()
+                if not retval:
+                    raise LpmsTerminate("Some errors occured while merging %s" % environment.fullname)
             
-            lpms.logger.info("finished %s/%s/%s-%s" % (
-                package.repo,
-                package.category,
-                package.name,
-                package.version)
-            )
+                lpms.logger.info("finished %s/%s/%s-%s" % (
+                    package.repo,
+                    package.category,
+                    package.name,
+                    package.version)
+                )
 
-            utils.xterm_title("lpms: %s/%s finished" % (
-                package.category,
-                package.name)
-            )
+                utils.xterm_title("lpms: %s/%s finished" % (
+                    package.category,
+                    package.name)
+                )
+
+                out.normal("Cleaning build directory")
+                shelltools.remove_dir(os.path.dirname(environment.install_dir))
+                catdir = os.path.dirname(os.path.dirname(environment.install_dir))
+                if not os.listdir(catdir):
+                    shelltools.remove_dir(catdir)
 
-            out.normal("Cleaning build directory")
-            shelltools.remove_dir(os.path.dirname(environment.install_dir))
-            catdir = os.path.dirname(os.path.dirname(environment.install_dir))
-            if not os.listdir(catdir):
-                shelltools.remove_dir(catdir)
+                # There is no error, exitting...
+                out.normal("Completed.")
+        finally:
+            if self.request.instruction.image_build:
+                # the indexes are created even if the image build fails
+                out.normal("creating database indexes")
+                try:
+                    for root in [None]+list(self.request.instruction.extra_roots or []):
+                        dbbase.use_root(root)
+                        dbapi.FilesDB().create_indexes()
+                finally:
+                    dbbase.use_root(None)
 
-            # There is no error, exitting...
-            out.normal("Completed.")
+        if build_cache is not None:
+            buildcache.show_statistics(build_cache)
 
 
 class LPMSCore(Operations):
@@ -235,4 +385,6 @@ def initialize():
     except LpmsTerminate as err:
         # TODO: Parse these err variable when debug mode is enabled.  
         out.write("Terminated.\n")
+    # Run the triggers of the merged packages once for the whole plan
+    triggers.TriggerQueue().run()
 
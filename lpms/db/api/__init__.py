@@ -211,11 +211,11 @@ class InstallDB:
     def __init__(self):
         self.database = installdb.InstallDatabase()
 
-    def insert_inline_options(self, package_id, target, options):
-        self.database.insert_inline_options(package_id, target, options)
+    def insert_inline_options(self, package_id, target, options, commit=True):
+        self.database.insert_inline_options(package_id, target, options, commit)
 
-    def update_inline_options(self, package_id, target, options):
-        self.database.update_inline_options(package_id, target, options)
+    def update_inline_options(self, package_id, target, options, commit=True):
+        self.database.update_inline_options(package_id, target, options, commit)
 
     def delete_inline_options(self, **kwargs):
         package_id = kwargs.get("package_id", None)
@@ -237,11 +237,11 @@ class InstallDB:
             del result_obj
         return result_objs
 
-    def insert_conditional_versions(self, package_id, target, decision_point):
-        self.database.insert_conditional_versions(package_id, target, decision_point)
+    def insert_conditional_versions(self, package_id, target, decision_point, commit=True):
+        self.database.insert_conditional_versions(package_id, target, decision_point, commit)
 
-    def update_conditional_versions(self, package_id, target, decision_point):
-        self.database.update_conditional_versions(package_id, target, decision_point)
+    def update_conditional_versions(self, package_id, target, decision_point, commit=True):
+        self.database.update_conditional_versions(package_id, target, decision_point, commit)
 
     def delete_conditional_versions(self, **kwargs):
         package_id = kwargs.get("package_id", None)
@@ -264,8 +264,8 @@ class InstallDB:
         return result_objs
 
     def insert_package(self, dataset, commit=False):
-        '''Creates a new installed package entry.'''
-        self.database.insert_package(dataset, commit)
+        '''Creates a new installed package entry and returns its id.'''
+        return self.database.insert_package(dataset, commit)
 
     def update_package(self, dataset, commit=False):
         '''Updates an installed package entry.'''
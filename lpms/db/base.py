@@ -18,6 +18,7 @@
 import os
 import sys
 import sqlite3
+import threading
 
 import lpms
 
@@ -25,6 +26,15 @@ from lpms import constants as cst
 
 from lpms.db import schemas
 
+# The root of the databases that are opened by the current thread,
+# it overrides --change-root
+local = threading.local()
+
+def use_root(root):
+    '''Makes the databases opened by this thread use the given root.
+    The repository database is shared by all roots.'''
+    local.root = root
+
 class LpmsDatabase(object):
     def __init__(self):
         root = cst.root
@@ -32,6 +42,9 @@ class LpmsDatabase(object):
             if option.startswith("--change-root"):
                 root = option.replace("--change-root=", "")
                 break
+        if getattr(local, "root", None) is not None and \
+                not self.__class__.__module__.endswith(cst.repositorydb):
+            root = local.root
         if self.__class__.__module__.endswith(cst.repositorydb):
             self.dbpath = os.path.join(root, cst.db_path, cst.repositorydb)+cst.db_prefix
         elif self.__class__.__module__.endswith(cst.installdb):
@@ -80,6 +93,16 @@ class LpmsDatabase(object):
                 continue
         return True
 
+    def attach(self, database, name):
+        '''Attaches the file of the given database to this connection and
+        makes the database use it. Then the writes of both databases are
+        committed in the same transaction.'''
+        self.cursor.execute('''ATTACH DATABASE ? AS %s''' % name, (database.dbpath,))
+        database.cursor.close()
+        database.connection.close()
+        database.connection = self.connection
+        database.cursor = self.connection.cursor()
+
     def begin_transaction(self):
         self.cursor.execute('''BEGIN TRANSACTION''')
 
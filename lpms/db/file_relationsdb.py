@@ -28,12 +28,9 @@ class FileRelationsDatabase(base.LpmsDatabase):
 
     def insert_query(self, commit=True):
         '''Inserts query'''
-        self.cursor.execute('BEGIN TRANSACTION')
-        for data in self.query:
-            repo, category, name, version, file_path, depends = data
-            for depend in depends:
-                self.cursor.execute('''insert into file_relations values(?, ?, ?, ?, ?, ?)''', (
-                    repo, category, name, version, file_path, depend,))
+        self.cursor.executemany('''insert into file_relations values(?, ?, ?, ?, ?, ?)''',
+                ((repo, category, name, version, file_path, depend) for repo, category, \
+                name, version, file_path, depends in self.query for depend in depends))
         del self.query
         self.query = []
         if commit: self.commit()
@@ -27,19 +27,34 @@ class FilesDatabase(base.LpmsDatabase):
     def __init__(self):
         super(FilesDatabase, self).__init__()
         self.query = []
+        # Image builds create the indexes when all packages are merged
+        if not lpms.getopt("--image-build"):
+            self.create_indexes()
+
+    def create_indexes(self):
+        '''Creates the indexes, older databases were created without them'''
+        self.cursor.execute('''CREATE INDEX IF NOT EXISTS files_path_idx ON files (path)''')
+        self.cursor.execute('''CREATE INDEX IF NOT EXISTS files_category_name_version_idx \
+                ON files (category, name, version)''')
+
+    def drop_indexes(self):
+        '''Drops the indexes, inserting many rows is faster without them'''
+        self.cursor.execute('''DROP INDEX IF EXISTS files_path_idx''')
+        self.cursor.execute('''DROP INDEX IF EXISTS files_category_name_version_idx''')
 
     def insert_query(self, commit=False):
         '''Inserts query items'''
-        self.cursor.execute('BEGIN TRANSACTION')
-        for data in self.query:
-            repo, category, name, version, path, _type, \
-                    size, gid, mod, uid, sha1sum, realpath, slot  = data
-            #FIXME:temporary fix for utf-8
-            path = path.decode('utf-8')
-            realpath = path.decode('utf-8')
-            self.cursor.execute('''insert into files values(?, ?, ?, ?, ?, ?, \
-                    ?, ?, ?, ?, ?, ?, ?)''', (repo, category, name, version, path, _type, \
-                    sqlite3.Binary(pickle.dumps(size, 1)), gid, mod, uid, sha1sum, realpath, slot))
+        def rows():
+            for data in self.query:
+                repo, category, name, version, path, _type, \
+                        size, gid, mod, uid, sha1sum, realpath, slot  = data
+                #FIXME:temporary fix for utf-8
+                path = path.decode('utf-8')
+                realpath = path.decode('utf-8')
+                yield (repo, category, name, version, path, _type, \
+                        sqlite3.Binary(pickle.dumps(size, 1)), gid, mod, uid, sha1sum, realpath, slot)
+        self.cursor.executemany('''insert into files values(?, ?, ?, ?, ?, ?, \
+                ?, ?, ?, ?, ?, ?, ?)''', rows())
         del self.query
         self.query = []
         if commit: self.commit()
@@ -53,6 +68,26 @@ class FilesDatabase(base.LpmsDatabase):
         self.cursor.execute('''select category, name, slot, version, path from files where type="file" or type="link"''')
         return self.cursor.fetchall()
 
+    def get_owners_by_paths(self, paths):
+        '''Gets the packages that own any of the given paths as files or links.
+        The paths are loaded into a temporary table and joined with the files
+        table, so only the rows of these paths are read. The paths of the
+        result are the given ones.'''
+        # The paths are stored as unicode, see insert_query
+        keys = {}
+        for path in paths:
+            keys[path.decode('utf-8') if isinstance(path, str) else path] = path
+        self.cursor.execute('''CREATE TEMP TABLE IF NOT EXISTS candidate_paths (path text)''')
+        self.cursor.execute('''DELETE FROM candidate_paths''')
+        self.cursor.executemany('''insert into candidate_paths values(?)''',
+                ((path,) for path in keys))
+        self.cursor.execute('''select files.path, category, name, slot, version from \
+                candidate_paths join files on files.path = candidate_paths.path \
+                where type="file" or type="link"''')
+        result = [(keys[item[0]],)+tuple(item[1:]) for item in self.cursor.fetchall()]
+        self.cursor.execute('''DROP TABLE candidate_paths''')
+        return result
+
     def get_package_by_path(self, path):
         '''Gets package data by the path'''
         self.cursor.execute('''select repo, category, name, version from \
@@ -102,6 +137,14 @@ class FilesDatabase(base.LpmsDatabase):
                 and name=(?) and version=(?)''', (category, name, version,))
         return self.cursor.fetchall()
 
+    def get_file_states_by_package(self, category, name, version):
+        '''Gets path, size, gid, mod, uid and sha1sum of the files of the package'''
+        self.cursor.execute('''select path, size, gid, mod, uid, sha1sum from files \
+                where type="file" and category=(?) and name=(?) and version=(?)''',
+                (category, name, version,))
+        return [(path, pickle.loads(str(size)), gid, mod, uid, sha1sum) for \
+                path, size, gid, mod, uid, sha1sum in self.cursor.fetchall()]
+
     def get_sha1sum_by_path(self, path):
         '''Gets sha1sum of path'''
         self.cursor.execute('''select sha1sum from files where path=(?)''',
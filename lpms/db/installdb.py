@@ -25,6 +25,13 @@ from lpms.db import base
 class InstallDatabase(base.LpmsDatabase):
     def __init__(self):
         super(InstallDatabase, self).__init__()
+        # Older databases were created without build_stats
+        self.cursor.executescript('''
+            CREATE TABLE IF NOT EXISTS build_stats(package_id INTEGER, stage TEXT, \
+                    wall_time REAL, user_time REAL, system_time REAL, max_rss INTEGER);
+            CREATE INDEX IF NOT EXISTS build_stats_package_id_idx ON build_stats (package_id);
+            CREATE TABLE IF NOT EXISTS merges(merge_id TEXT);
+        ''')
     
     def insert_package(self, dataset, commit=False):
         # Firstly, convert Python data types to store in the SQLite3 database.
@@ -55,8 +62,10 @@ class InstallDatabase(base.LpmsDatabase):
                 optional_depends_conflict, static_depends_build, static_depends_runtime, static_depends_postmerge, \
                 static_depends_conflict))
 
+        package_id = self.cursor.lastrowid
         if commit:
             self.commit()
+        return package_id
 
     def update_package(self, dataset, commit=False):
         # Firstly, convert Python data types to store in the SQLite3 database.
@@ -214,6 +223,34 @@ class InstallDatabase(base.LpmsDatabase):
         self.cursor.execute('''SELECT * FROM build_info WHERE package_id = (?)''', (package_id,))
         return self.cursor.fetchone()
 
+    def mark_merge(self, merge_id, commit=True):
+        '''Keeps the id of the last merge, see lpms.journal'''
+        self.cursor.execute('''DELETE FROM merges''')
+        self.cursor.execute('''INSERT INTO merges VALUES (?)''', (merge_id,))
+        if commit: self.commit()
+
+    def delete_build_stats(self, package_id, commit=True):
+        self.cursor.execute('''DELETE FROM build_stats WHERE package_id = (?)''', (package_id,))
+        if commit: self.commit()
+
+    def insert_build_stats(self, package_id, stage_stats, commit=True):
+        '''stage_stats is a list of (stage, wall time, user time, system time, max rss)'''
+        self.cursor.executemany('''INSERT INTO build_stats VALUES (?, ?, ?, ?, ?, ?)''', \
+                [(package_id,)+tuple(item) for item in stage_stats])
+        if commit: self.commit()
+
+    def get_build_stats(self, package_id):
+        self.cursor.execute('''SELECT stage, wall_time, user_time, system_time, max_rss \
+                FROM build_stats WHERE package_id = (?) ORDER BY rowid''', (package_id,))
+        return self.cursor.fetchall()
+
+    def get_all_build_stats(self):
+        self.cursor.execute('''SELECT package.repo, package.category, package.name, \
+                package.version, build_stats.stage, build_stats.wall_time, build_stats.user_time, \
+                build_stats.system_time, build_stats.max_rss FROM build_stats \
+                JOIN package ON package.id = build_stats.package_id''')
+        return self.cursor.fetchall()
+
     def insert_inline_options(self, package_id, target, options, commit=True):
         options = sqlite3.Binary(pickle.dumps(options, 1))
         self.cursor.execute('''INSERT INTO inline_options VALUES (?, ?, ?)''', \
@@ -58,6 +58,19 @@ def installdb():
             cxx TEXT
         );
 
+        CREATE TABLE merges(
+            merge_id TEXT
+        );
+
+        CREATE TABLE build_stats(
+            package_id INTEGER,
+            stage TEXT,
+            wall_time REAL,
+            user_time REAL,
+            system_time REAL,
+            max_rss INTEGER
+        );
+
         CREATE TABLE conditional_versions(
             package_id INTEGER,
             target TEXT,
@@ -70,6 +83,7 @@ def installdb():
             options BLOB
         );
 
+        CREATE INDEX build_stats_package_id_idx ON build_stats (package_id);
         CREATE INDEX inline_options_package_id_target_idx ON inline_options (package_id, target);
         CREATE INDEX inline_options_package_id_options_idx ON inline_options (package_id, options);
         CREATE INDEX inline_options_target_options_idx ON inline_options (target, options);
@@ -164,6 +178,7 @@ def filesdb():
             realpath text,
             slot text
         );
-        CREATE INDEX repo_category_name_version_path_idx ON file_relations (repo, category, name, version, path);
+        CREATE INDEX files_path_idx ON files (path);
+        CREATE INDEX files_category_name_version_idx ON files (category, name, version);
     """
 
@@ -64,6 +64,7 @@ class ConstantValues:
         self.val.repo_conf = "/etc/lpms/repo.conf"
         self.val.configure_pending_file = "var/db/lpms/configure_pending.db"
         self.val.merge_conf_file = "var/db/lpms/merge_conf.db"
+        self.val.merge_journal = "var/db/lpms/merge.journal"
         self.val.repo_file = "info/repo.conf"
         self.val.repo_info = "info"
         self.val.categories = "categories.xml"
@@ -90,6 +91,13 @@ class ConstantValues:
         self.val.lock_file = self.val.extract_dir+"lock"
         self.val.resume_file = "var/tmp/lpms/"+"resume"
         self.val.src_cache = "/var/cache/lpms/sources"
+        self.val.extract_cache = "/var/cache/lpms/extracted"
+        self.val.extract_cache_size = 4096
+        self.val.build_cache = "/var/cache/lpms/builds"
+        self.val.build_cache_size = 8192
+        self.val.binary_packages = "/var/cache/lpms/packages"
+        self.val.binary_suffix = ".lpkg"
+        self.val.binary_index = "index.json"
         self.val.news_dir = "news"
         self.val.news_read = "news.read"
         self.val.ccache_dir = "/var/cache/ccache"
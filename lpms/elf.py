@@ -0,0 +1,296 @@
+# Copyright 2009 - 2011 Burak Sezer <purak@hadronproject.org>
+#
+# This file is part of lpms
+#
+# lpms is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# lpms is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with lpms.  If not, see <http://www.gnu.org/licenses/>.
+
+# A small ELF reader. It reads the headers and the dynamic section of
+# executables and shared libraries, and resolves their dependencies
+# the way the dynamic linker does, without running ldd.
+
+import os
+import re
+import glob
+import struct
+
+ELF_MAGIC = "\x7fELF"
+AR_MAGIC = "!<arch>\n"
+
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+ET_REL = 1
+ET_EXEC = 2
+ET_DYN = 3
+
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_INTERP = 3
+
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_STRSZ = 10
+DT_SONAME = 14
+DT_RPATH = 15
+DT_RUNPATH = 29
+
+# The mimetypes that libmagic reports for these objects
+mimetypes = {
+        ET_REL: 'application/x-object',
+        ET_EXEC: 'application/x-executable',
+        ET_DYN: 'application/x-sharedlib',
+}
+
+# sonames of the dynamic linkers of glibc and musl
+dynamic_linker = re.compile(r"^ld(-linux[^/]*|64|-musl-[^/]*)?\.so(\.[0-9]+)*$")
+
+# Searched after the ld.so.conf entries
+default_library_dirs = ('lib64', 'usr/lib64', 'lib', 'usr/lib')
+
+class ELFError(Exception):
+    pass
+
+class ELFFile(object):
+    '''Parses the headers and the dynamic section of an ELF object'''
+    def __init__(self, path):
+        self.path = path
+        self.needed = []
+        self.soname = None
+        self.rpath = []
+        self.runpath = []
+        self.interpreter = None
+        with open(path, "rb") as myfile:
+            self.parse(myfile)
+
+    def parse(self, myfile):
+        ident = myfile.read(16)
+        if len(ident) < 16 or ident[:4] != ELF_MAGIC:
+            raise ELFError("%s is not an ELF file" % self.path)
+        self.elfclass, self.data = ord(ident[4]), ord(ident[5])
+        if self.elfclass not in (ELFCLASS32, ELFCLASS64) or \
+                self.data not in (ELFDATA2LSB, ELFDATA2MSB):
+            raise ELFError("%s has an unknown ELF class" % self.path)
+        endian = "<" if self.data == ELFDATA2LSB else ">"
+        word = "I" if self.elfclass == ELFCLASS32 else "Q"
+
+        header_format = endian+"HHI"+word*3+"IHHHHHH"
+        header = self.read(myfile, 16, struct.calcsize(header_format))
+        (self.type, self.machine, version, entry, phoff, shoff, flags, ehsize, \
+                phentsize, phnum, shentsize, shnum, shstrndx) = \
+                struct.unpack(header_format, header)
+
+        # Program headers map the virtual addresses to file offsets
+        if self.elfclass == ELFCLASS32:
+            phdr_format = endian+"IIIIIIII"
+        else:
+            phdr_format = endian+"IIQQQQQQ"
+        loads = []; dynamic = None
+        for index in range(phnum):
+            phdr = struct.unpack(phdr_format, self.read(myfile, phoff+index*phentsize, \
+                    struct.calcsize(phdr_format)))
+            if self.elfclass == ELFCLASS32:
+                p_type, p_offset, p_vaddr, p_paddr, p_filesz = phdr[:5]
+            else:
+                p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz = phdr[:6]
+            if p_type == PT_LOAD:
+                loads.append((p_vaddr, p_offset, p_filesz))
+            elif p_type == PT_DYNAMIC:
+                dynamic = (p_offset, p_filesz)
+            elif p_type == PT_INTERP:
+                self.interpreter = self.read(myfile, p_offset, p_filesz).rstrip("\0")
+        if dynamic is None:
+            return
+
+        entry_format = endian+("ii" if self.elfclass == ELFCLASS32 else "qQ")
+        entry_size = struct.calcsize(entry_format)
+        entries = []; strtab = None; strsz = None
+        raw = self.read(myfile, dynamic[0], dynamic[1])
+        for offset in range(0, len(raw) - entry_size + 1, entry_size):
+            tag, value = struct.unpack(entry_format, raw[offset:offset+entry_size])
+            if tag == DT_NULL:
+                break
+            if tag == DT_STRTAB:
+                strtab = value
+            elif tag == DT_STRSZ:
+                strsz = value
+            elif tag in (DT_NEEDED, DT_SONAME, DT_RPATH, DT_RUNPATH):
+                entries.append((tag, value))
+        if strtab is None:
+            return
+
+        strtab_offset = None
+        for vaddr, offset, size in loads:
+            if vaddr <= strtab < vaddr+size:
+                strtab_offset = strtab - vaddr + offset
+                break
+        if strtab_offset is None:
+            raise ELFError("%s has an invalid string table" % self.path)
+        strings = self.read(myfile, strtab_offset, strsz)
+
+        for tag, value in entries:
+            string = strings[value:strings.find("\0", value)]
+            if tag == DT_NEEDED:
+                self.needed.append(string)
+            elif tag == DT_SONAME:
+                self.soname = string
+            elif tag == DT_RPATH:
+                self.rpath.extend([item for item in string.split(":") if item])
+            elif tag == DT_RUNPATH:
+                self.runpath.extend([item for item in string.split(":") if item])
+
+    def read(self, myfile, offset, size):
+        myfile.seek(offset)
+        data = myfile.read(size)
+        if len(data) != size:
+            raise ELFError("%s is truncated" % self.path)
+        return data
+
+    @property
+    def mimetype(self):
+        return mimetypes.get(self.type, None)
+
+def open_elf(path):
+    '''Returns an ELFFile or None if the path is not a valid ELF object'''
+    try:
+        return ELFFile(path)
+    except (ELFError, IOError, OSError, struct.error):
+        return None
+
+def get_mimetype(path):
+    '''Identifies ELF objects and ar archives without libmagic.
+    Returns None for other files.'''
+    try:
+        with open(path, "rb") as myfile:
+            magic = myfile.read(8)
+    except (IOError, OSError):
+        return None
+    if magic == AR_MAGIC:
+        return 'application/x-archive'
+    if magic[:4] != ELF_MAGIC:
+        return None
+    elf = open_elf(path)
+    if elf is None:
+        return None
+    return elf.mimetype
+
+def parse_ld_so_conf(root, path, seen=None):
+    '''Returns the library directories from ld.so.conf and its includes'''
+    if seen is None:
+        seen = set()
+    if path in seen or not os.path.isfile(path):
+        return []
+    seen.add(path)
+    directories = []
+    with open(path) as data:
+        for line in data:
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            if line.startswith("include"):
+                for pattern in line.split()[1:]:
+                    if not pattern.startswith("/"):
+                        pattern = os.path.join(os.path.dirname(path), pattern)
+                    else:
+                        pattern = os.path.join(root, pattern[1:])
+                    for include in sorted(glob.glob(pattern)):
+                        directories.extend(parse_ld_so_conf(root, include, seen))
+            elif not line.startswith("hwcap"):
+                directories.extend([item for item in line.replace(",", " ").split() \
+                        if item.startswith("/")])
+    return directories
+
+class Resolver(object):
+    '''Resolves DT_NEEDED entries to library paths. Parsed objects and
+    lookups are cached, so a library is read once per merge.'''
+    def __init__(self, root="/"):
+        self.root = root
+        self.objects = {}
+        self.lookups = {}
+        self.search_path = []
+        for directory in parse_ld_so_conf(root, os.path.join(root, "etc/ld.so.conf")) + \
+                ["/"+item for item in default_library_dirs]:
+            if not directory in self.search_path:
+                self.search_path.append(directory)
+
+    def parse(self, path):
+        if not path in self.objects:
+            self.objects[path] = open_elf(path)
+        return self.objects[path]
+
+    def compatible(self, elf, library):
+        return library is not None and library.elfclass == elf.elfclass \
+                and library.machine == elf.machine
+
+    def expand(self, directory, elf):
+        '''Expands $ORIGIN and relocates absolute paths into the root'''
+        origin = os.path.dirname(elf.path)
+        directory = directory.replace("${ORIGIN}", origin).replace("$ORIGIN", origin)
+        if directory.startswith(origin):
+            return directory
+        return os.path.join(self.root, directory.lstrip("/"))
+
+    def find(self, soname, elf, rpath):
+        '''Finds a library like the dynamic linker: DT_RPATH if there is no
+        DT_RUNPATH, then DT_RUNPATH, then ld.so.conf and the default directories'''
+        if "/" in soname:
+            return soname if self.compatible(elf, self.parse(soname)) else None
+        search = []
+        if not elf.runpath:
+            search.extend([self.expand(item, elf) for item in rpath])
+        search.extend([self.expand(item, elf) for item in elf.runpath])
+        key = (soname, elf.elfclass, elf.machine, tuple(search))
+        if key in self.lookups:
+            return self.lookups[key]
+        result = None
+        for directory in search + [os.path.join(self.root, item.lstrip("/")) \
+                for item in self.search_path]:
+            candidate = os.path.join(directory, soname)
+            if os.path.exists(candidate) and self.compatible(elf, self.parse(candidate)):
+                result = candidate
+                break
+        self.lookups[key] = result
+        return result
+
+    def depends(self, path):
+        '''Returns the real paths of all libraries that the object loads,
+        in the breadth-first order of the dynamic linker'''
+        elf = self.parse(path)
+        if elf is None:
+            return []
+        result = []; seen = set()
+        # ldd does not list the dynamic linker among the dependencies
+        if elf.interpreter is not None:
+            seen.add(os.path.realpath(os.path.join(self.root, elf.interpreter.lstrip("/"))))
+        # DT_RPATH of the loading objects is inherited by their dependencies
+        queue = [(elf, elf.rpath)]
+        while queue:
+            current, rpath = queue.pop(0)
+            for soname in current.needed:
+                if dynamic_linker.match(os.path.basename(soname)):
+                    continue
+                library = self.find(soname, current, rpath)
+                if library is None:
+                    continue
+                realpath = os.path.realpath(library)
+                if realpath in seen:
+                    continue
+                seen.add(realpath)
+                result.append(realpath)
+                child = self.parse(library)
+                if child is not None:
+                    queue.append((child, child.rpath + rpath))
+        return result
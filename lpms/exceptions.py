@@ -93,3 +93,6 @@ class AlreadyRunning(Exception):
 
 class LpmsTerminate(Exception):
     pass
+
+class BinaryPackageError(Exception):
+    pass
@@ -20,6 +20,7 @@
 import os
 import sys
 import time
+import hashlib
 import urllib2
 import urlparse
 import subprocess
@@ -31,6 +32,7 @@ from lpms import constants
 from lpms import shelltools
 from lpms import conf
 from lpms import utils
+from lpms import archive
 
 # simple file downloader for lpms 
 # based on http://stackoverflow.com/questions/2028517/python-urllib2-progress-hook
@@ -45,7 +47,7 @@ config = conf.LPMSConfig()
 
 class URLFetcher:
     def __init__(self):
-        self.chunk_size = 8192
+        self.chunk_size = 64*1024
         self.begining  = time.time()
         
     def estimated_time(self, current_size, total_size, time):
@@ -73,7 +75,7 @@ class URLFetcher:
             sys.stdout.write('\n')
         sys.stdout.flush()
 
-    def download(self, url, location=None, report_hook=None):
+    def download(self, url, location=None, report_hook=None, hashes=None):
         # ui.debug("URL: "+str(url))
         try:
             response = urllib2.urlopen(url)
@@ -92,27 +94,74 @@ class URLFetcher:
             localfile = os.path.join(location, filename)
         #ui.debug("Destination: "+localFile)
         partfile = localfile + ".part"
-        total_size = int(response.info().getheader('Content-Length').strip())
+        content_length = response.info().getheader('Content-Length')
+        total_size = int(content_length.strip()) if content_length else 0
         bytes_so_far = 0
-        
+        sha1 = hashlib.sha1()
+
+        # In stream mode, the archive is extracted while it is downloaded
+        cache = None; stream = None
+        if location is None and hasattr(config, "stream_extract") and config.stream_extract:
+            cache = archive.extract_cache(config)
+            staging = cache.stage()
+            stream = archive.stream_extractor(filename, os.path.join(staging, "tree"))
+            if stream is None:
+                cache.discard(staging)
+
         file = open(partfile, "wb")
-        
-        while True:
-            chunk = response.read(self.chunksize)
-            bytes_so_far += len(chunk)
-            if not chunk:
-                break
-            if report_hook:
-                report_hook(bytes_so_far, total_size, filename)	
+
+        try:
+            while True:
+                chunk = response.read(self.chunk_size)
+                if not chunk:
+                    break
+                bytes_so_far += len(chunk)
                 file.write(chunk)
-                
-        file.flush()
-        file.close()
-        
+                sha1.update(chunk)
+                if stream is not None:
+                    stream.write(chunk)
+                if report_hook and total_size:
+                    report_hook(bytes_so_far, total_size, filename)
+        except:
+            if stream is not None:
+                stream.abort()
+                cache.discard(staging)
+            raise
+        finally:
+            file.close()
+
+        # Nothing is published before the checksum is verified
+        if not self.verify(filename, sha1.hexdigest(), bytes_so_far, hashes):
+            if stream is not None:
+                stream.abort()
+                cache.discard(staging)
+            os.remove(partfile)
+            return False
+
+        if stream is not None:
+            if stream.finish():
+                cache.publish(staging, sha1.hexdigest())
+            else:
+                out.warn("%s could not be extracted during the download" % filename)
+                cache.discard(staging)
+
         if os.stat(str(partfile)).st_size == 0:
             os.remove(partfile)
-        move(partfile, localfile)
+            return False
+        shelltools.move(partfile, localfile)
         return bytes_so_far
+
+    def verify(self, filename, sha1, size, hashes):
+        '''Compares a downloaded file with its entry in the hashes file'''
+        if hashes is None or filename not in hashes:
+            return True
+        expected_sha1, expected_size = hashes[filename][:2]
+        if sha1 != expected_sha1 or str(size) != expected_size:
+            out.error("%s checksum mismatch" % out.color(filename, "red"))
+            out.write("    expected: %s %s bytes\n" % (expected_sha1, expected_size))
+            out.write("    received: %s %s bytes\n" % (sha1, size))
+            return False
+        return True
     
     # use external program to retrieve package sources
     
@@ -155,11 +204,42 @@ class URLFetcher:
                 lpms.terminate()
 
     # download_plan is a list that must contain urls
-    def run(self, download_plan, location=None):
+    def run(self, download_plan, location=None, hashes=None):
+        '''hashes is the path of the package's hashes file. The downloaded
+        files are checked against it before the build starts.'''
+        if hashes is not None:
+            hashes = load_hashes(hashes)
         # this is no good!
         if config.external_fetcher:
-            return self.external_fetcher(config.fetch_command, download_plan, location)
+            if not self.external_fetcher(config.fetch_command, download_plan, location):
+                return False
+            for url in download_plan:
+                filename = os.path.basename(url)
+                # the files that have no entry are not read
+                if hashes is None or filename not in hashes:
+                    continue
+                localfile = os.path.join(location if location is not None \
+                        else config.src_cache, filename)
+                if not self.verify(filename, utils.sha1sum(localfile), \
+                        os.path.getsize(localfile), hashes):
+                    shelltools.remove_file(localfile)
+                    return False
+            return True
         else:
             for url in download_plan:
-                return self.download(url, location, report_hook=self.fetcher_ui)
+                if not self.download(url, location, report_hook=self.fetcher_ui, hashes=hashes):
+                    return False
+            return True
 
+def load_hashes(path):
+    '''Parses a hashes file. Every line is a file name, its sha1sum and its size.'''
+    hashes = {}
+    if not os.path.isfile(path):
+        return hashes
+    with open(path) as data:
+        for line in data:
+            fields = line.split()
+            if len(fields) < 3:
+                continue
+            hashes[fields[0]] = fields[1:]
+    return hashes
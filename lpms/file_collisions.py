@@ -22,6 +22,7 @@ from lpms import out
 from lpms import constants as cst
 
 from lpms.db import api
+from lpms.types import PathTree
 
 class CollisionProtect:
     def __init__(self, category, name, slot, version=None, \
@@ -30,19 +31,16 @@ class CollisionProtect:
         self.files_and_links = {}
         self.source_dir = source_dir
         self.filesdb = api.FilesDB()
-        self.prepare_files_and_links()
         self.orphans = []
         self.collisions = []
         self.name = name
         self.category = category
         self.slot = slot
         self.version = version
-        self.symlinks = []
+        self.symlinks = PathTree()
 
     def is_parent_symlink(self, target):
-        for symlink in self.symlinks:
-            if target.startswith(symlink):
-                return True
+        return self.symlinks.has_parent(target)
 
     def catch_file(self, mypath):
         if mypath in self.files_and_links:
@@ -58,18 +56,20 @@ class CollisionProtect:
             if os.path.exists(mypath):
                 self.orphans.append(mypath)
 
-    def prepare_files_and_links(self):
-        root_path = cst.root
-        if self.real_root != cst.root:
-            root_path = self.real_root
-        for item in self.filesdb.get_files_and_links():
-            mypath = os.path.join(root_path, item[-1][1:])
-            if item[-1] in self.files_and_links:
-                self.files_and_links[mypath].append(item[:-1])
-                continue
-            self.files_and_links.update({mypath: [item[:-1]]})
+    def prepare_files_and_links(self, paths):
+        '''Loads the owners of the given paths from the files database.
+        Only the rows of the candidate paths are read.'''
+        for item in self.filesdb.get_owners_by_paths(paths):
+            mypath = self.root_path(item[0])
+            self.files_and_links.setdefault(mypath, []).append(item[1:])
+
+    def root_path(self, path):
+        if self.real_root is not None and self.real_root != cst.root:
+            return os.path.join(self.real_root, path[1:])
+        return path
 
     def handle_collisions(self):
+        candidates = []
         if self.source_dir:
             for root_path, dirs, files in os.walk(self.source_dir, \
                     followlinks=True):
@@ -77,21 +77,19 @@ class CollisionProtect:
                     target_dir = os.path.join(root_path, __dir)
                     if os.path.islink(target_dir):
                         target_dir = "".join(target_dir.split(self.source_dir))
-                        self.symlinks.append(target_dir+"/")
+                        self.symlinks.add(target_dir)
 
                 root_path = "".join(root_path.split(self.source_dir))
                 if not files: continue
                 for item in files:
-                    if self.real_root != cst.root:
-                        root_path = os.path.join(self.real_root, root_path[1:])
                     mypath = os.path.join(root_path, item)
                     if self.is_parent_symlink(mypath): break
-                    self.catch_file(mypath)
+                    candidates.append(mypath)
         else:
             for path in self.filesdb.get_files_and_links_by_package(self.category, \
                     self.name, self.version):
-                mypath = path[0]
-                if self.real_root != cst.root:
-                    mypath = os.path.join(self.real_root, mypath[1:])
-                self.catch_file(mypath)
+                candidates.append(path[0])
+        self.prepare_files_and_links(candidates)
+        for path in candidates:
+            self.catch_file(self.root_path(path))
         del self.files_and_links
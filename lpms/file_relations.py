@@ -16,46 +16,38 @@
 # along with lpms.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
-import subprocess
 
 import lpms
 from lpms import out
-from lpms import utils
-from lpms import shelltools
+from lpms import elf
 
 from lpms.db import api
 from lpms.exceptions import FileNotFound
 
-ldd_path = utils.executable_path("ldd")
+binary_filetypes = ('application/x-executable', 'application/x-archive', \
+        'application/x-sharedlib')
 
-def remove_duplications(data): return list(set(data))
+_resolver = None
 
-def get_depends(file_path):
-    '''Parses ldd's output and returns depends of shared lib or executable file'''
-    depends = []
-    if not os.access(ldd_path, os.X_OK):
-        out.error("%s seems problematic. please check it." % ldd_path)
-        lpms.terminate()
+def remove_duplications(data): return list(set(data))
 
+def get_depends(file_path, resolver=None):
+    '''Reads the dynamic section of shared lib or executable file and returns
+    the real paths of the libraries it loads. resolver is an elf.Resolver,
+    the results of previous lookups are reused if it is shared.'''
+    global _resolver
     if not os.path.exists(file_path):
         raise FileNotFound("%s not found." % file_path)
     
-    if not utils.get_mimetype(file_path) in ('application/x-executable', \
-            'application/x-archive', 'application/x-sharedlib'):
+    if not elf.get_mimetype(file_path) in binary_filetypes:
         out.error("%s is invalid for me." % file_path)
-        return
+        return []
 
-    for line in subprocess.Popen([ldd_path, file_path], \
-            stdout=subprocess.PIPE).stdout:
-        data = line.strip().split("=>")
-        if len(data) == 2:
-            parsed = data[1].split(" ")
-            if parsed[1] != "":
-                if shelltools.is_link(parsed[1]):
-                    depends.append(shelltools.real_path(parsed[1]))
-                else:
-                    depends.append(parsed[1])
-    return depends
+    if resolver is None:
+        if _resolver is None:
+            _resolver = elf.Resolver()
+        resolver = _resolver
+    return resolver.depends(file_path)
 
 def get_packages(category, name, version):
     relationsdb = api.FileRelationsDB()
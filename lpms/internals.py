@@ -45,6 +45,7 @@ class InternalFunctions(object):
         self.env = Environment()
         self.env.libraries = []
         self.env.reserve_files = []
+        self.env.triggers = []
         self.env.current_stage = None
         self.env.config = ""
         self.env.sandbox_valid_dirs = []
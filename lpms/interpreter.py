@@ -32,6 +32,7 @@ from lpms import conf
 from lpms import utils
 from lpms import internals
 from lpms import exceptions
+from lpms import buildstats
 from lpms import shelltools
 
 from lpms.shelltools import touch
@@ -397,6 +398,11 @@ class ScriptEngine(internals.InternalFunctions):
                         operation_order.insert(len(operation_order), 'post_install')
                         break
 
+            # A binary package or a cached build is already built and installed
+            if self.environment.prebuilt:
+                operation_order = [operation for operation in operation_order \
+                        if operation == 'post_install']
+
         if remove and 'pre_remove' in self.environment.raw and not 'pre_remove' in operation_order:
             operation_order.insert(0, 'pre_remove')
 
@@ -445,7 +451,13 @@ class ScriptEngine(internals.InternalFunctions):
             try:
                 if self.environment.build_dir is not None and os.getcwd() != self.environment.build_dir:
                     os.chdir(self.environment.build_dir)
-                method()
+                with buildstats.measure(self.environment, operation):
+                    if operation in cst.sandbox_exception_stages:
+                        method()
+                    else:
+                        # The sandboxed commands of the stage share one sandbox
+                        with shelltools.session():
+                            method()
             except KeyboardInterrupt:
                 # Return None as retval because this is neither an error nor successfully completed operation. 
                 # This is an user interrupt.
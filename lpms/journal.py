@@ -0,0 +1,273 @@
+# Copyright 2009 - 2011 Burak Sezer <purak@hadronproject.org>
+#
+# This file is part of lpms
+#
+# lpms is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# lpms is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with lpms.  If not, see <http://www.gnu.org/licenses/>.
+
+# Merge journal. A merge records what it is going to do before doing it:
+#
+#   ["begin", package, id]      a merge has started
+#   ["mkdir", path]             a new directory is created
+#   ["aside", path, had_old]    path is replaced in place, a directory or a
+#                               file that is in the way is moved to
+#                               path.lpms-old until the end
+#   ["stage", path]             a file is staged as path.lpms-new
+#   ["replace", path, had_old]  path.lpms-new is renamed to path, the old
+#                               file is kept as path.lpms-old until the end
+#   ["done"]                    the databases are written
+#
+# Files are staged next to their targets, so replacing them is a rename
+# on the same filesystem. The id of the merge is written to installdb in
+# the transaction of the merge. If lpms dies before "done", the next run
+# rolls the merge back unless installdb has the id; then the merge is
+# completed and only the old files are removed.
+#
+# A merge holds an exclusive lock on the journal of its root, recovery
+# leaves the journal of a merge that is still running alone.
+
+import os
+import json
+import uuid
+import errno
+import fcntl
+import shutil
+import sqlite3
+
+from lpms import out
+from lpms import constants as cst
+
+new_suffix = ".lpms-new"
+old_suffix = ".lpms-old"
+
+def journal_path(root):
+    return os.path.join(root, cst.merge_journal)
+
+def remove(path):
+    try:
+        os.unlink(path)
+    except OSError, err:
+        if err.errno != errno.ENOENT:
+            raise
+
+def remove_tree(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        remove(path)
+
+def lock(root, blocking=True):
+    '''Locks the journal of the root. Returns the lock file or None if
+    another process holds the lock and blocking is False.'''
+    path = journal_path(root)+".lock"
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    lock_file = open(path, "w")
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX if blocking else \
+                fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError, err:
+        lock_file.close()
+        if err.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    return lock_file
+
+class Journal(object):
+    '''Records the operations of a merge and applies the staged files'''
+    def __init__(self, root, sync=True):
+        '''If sync is False, the journal is not flushed to the disk'''
+        self.root = root
+        self.path = journal_path(root)
+        self.sync = sync
+        self.journal = None
+        self.lock = None
+        self.id = None
+        self.staged = []
+        self.replaced = []
+        self.directories = []
+        self.aside = []
+
+    def write(self, entry, sync=False):
+        self.journal.write(json.dumps(entry)+"\n")
+        self.journal.flush()
+        if sync and self.sync:
+            os.fsync(self.journal.fileno())
+
+    def begin(self, package):
+        '''Starts the journal, the merges of the same root wait for each other'''
+        self.lock = lock(self.root)
+        self.id = uuid.uuid4().hex
+        self.journal = open(self.path, "w")
+        self.write(["begin", package, self.id], sync=True)
+
+    def unlock(self):
+        if self.lock is not None:
+            self.lock.close()
+            self.lock = None
+
+    def mkdir(self, path):
+        '''Records a directory that is going to be created'''
+        self.write(["mkdir", path])
+        self.directories.append(path)
+
+    def set_aside(self, path):
+        '''Moves whatever is at path out of the way, path is going to be
+        replaced by a directory or a symlink in place'''
+        had_old = os.path.lexists(path)
+        self.write(["aside", path, had_old], sync=had_old)
+        if had_old:
+            remove_tree(path+old_suffix)
+            os.rename(path, path+old_suffix)
+        self.aside.append((path, had_old))
+
+    def stage(self, target):
+        '''Returns the staging path of the target'''
+        self.write(["stage", target])
+        self.staged.append(target)
+        remove(target+new_suffix)
+        return target+new_suffix
+
+    def install(self):
+        '''Renames the staged files to their targets. The old files
+        are kept until finish is called.'''
+        replaces = [(target, os.path.lexists(target)) for target in self.staged]
+        for target, had_old in replaces:
+            self.write(["replace", target, had_old])
+        if self.sync:
+            os.fsync(self.journal.fileno())
+        for target, had_old in replaces:
+            if had_old:
+                remove(target+old_suffix)
+                os.link(target, target+old_suffix)
+            os.rename(target+new_suffix, target)
+            self.replaced.append((target, had_old))
+        self.staged = []
+
+    def finish(self):
+        '''Marks the merge as done and removes the old files'''
+        self.write(["done"], sync=True)
+        self.journal.close()
+        cleanup([["aside", path, had_old] for path, had_old in self.aside]+ \
+                [["replace", target, had_old] for target, had_old in self.replaced])
+        remove(self.path)
+        self.unlock()
+
+    def rollback(self):
+        '''Undoes the merge that is still in progress'''
+        if self.journal is None:
+            return
+        self.journal.close()
+        # The entries are undone in the reverse order of the journal
+        rollback(read(self.path))
+        remove(self.path)
+        self.unlock()
+
+def cleanup(entries):
+    '''Removes the old files of the replaced paths'''
+    for entry in entries:
+        if entry[0] in ("replace", "aside") and entry[2]:
+            remove_tree(entry[1]+old_suffix)
+
+def rollback(entries):
+    '''Restores the state before the recorded operations'''
+    for entry in reversed(entries):
+        if entry[0] == "replace":
+            target, had_old = entry[1:]
+            if os.path.lexists(target+new_suffix):
+                # it is not renamed yet, the target is still the old file
+                remove(target+new_suffix)
+                remove(target+old_suffix)
+            elif had_old and os.path.lexists(target+old_suffix):
+                os.rename(target+old_suffix, target)
+            elif not had_old:
+                remove(target)
+        elif entry[0] == "stage":
+            remove(entry[1]+new_suffix)
+            remove(entry[1]+new_suffix+".lpms-tmp")
+        elif entry[0] == "mkdir":
+            try:
+                os.rmdir(entry[1])
+            except OSError:
+                pass
+        elif entry[0] == "aside":
+            path, had_old = entry[1:]
+            if had_old and not os.path.lexists(path+old_suffix):
+                # it was not moved yet
+                continue
+            if os.path.isdir(path) and not os.path.islink(path):
+                try:
+                    os.rmdir(path)
+                except OSError:
+                    pass
+            else:
+                remove(path)
+            if had_old:
+                os.rename(path+old_suffix, path)
+
+def read(path):
+    entries = []
+    with open(path) as journal:
+        for line in journal:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # the last line may be written partially
+                break
+    return entries
+
+def is_committed(root, merge_id):
+    '''Checks whether installdb of the root has the merge'''
+    path = os.path.join(root, cst.db_path, cst.installdb)+cst.db_prefix
+    if merge_id is None or not os.path.isfile(path):
+        return False
+    connection = sqlite3.connect(path)
+    try:
+        return connection.execute('''SELECT merge_id FROM merges WHERE merge_id = (?)''', \
+                (merge_id,)).fetchone() is not None
+    except sqlite3.OperationalError:
+        # the table is created by the first merge
+        return False
+    finally:
+        connection.close()
+
+def recover(root):
+    '''Completes or rolls back the merge that was interrupted'''
+    path = journal_path(root)
+    if not os.path.isfile(path):
+        return
+    lock_file = lock(root, blocking=False)
+    if lock_file is None:
+        # another lpms process is merging to the root
+        return
+    try:
+        if not os.path.isfile(path):
+            return
+        entries = read(path)
+        package, merge_id = "unknown package", None
+        if entries and entries[0][0] == "begin":
+            package = entries[0][1]
+            merge_id = entries[0][2] if len(entries[0]) > 2 else None
+        if ["done"] in entries or is_committed(root, merge_id):
+            # Renames that were not done yet are completed
+            for entry in entries:
+                if entry[0] == "replace" and os.path.lexists(entry[1]+new_suffix):
+                    os.rename(entry[1]+new_suffix, entry[1])
+            cleanup(entries)
+            out.warn("the interrupted merge of %s has been completed." % package)
+        else:
+            rollback(entries)
+            out.warn("the interrupted merge of %s has been rolled back." % package)
+        remove(path)
+    finally:
+        lock_file.close()
@@ -25,6 +25,8 @@ import lpms
 from lpms import out
 from lpms import conf
 from lpms import utils
+from lpms import binary
+from lpms import buildcache
 from lpms import fetcher
 from lpms import internals
 from lpms import initpreter
@@ -34,7 +36,7 @@ from lpms import constants as cst
 
 from lpms.db import api
 from lpms.operations import merge
-from lpms.exceptions import BuildError
+from lpms.exceptions import BuildError, BinaryPackageError
 
 class Build(object):
     '''
@@ -51,6 +53,8 @@ class Build(object):
         self.conditional_versions=kwargs.get("conditional_versions", None)
         self.conflicts=kwargs.get("conflicts", None)
         self.inline_option_targets=kwargs.get("inline_option_targets", None)
+        # (repository, index entry) of a matching binary package
+        self.binary_package=kwargs.get("binary_package", None)
         
         # Internal variables 
         self.repodb = api.RepositoryDB()
@@ -299,6 +303,8 @@ class Build(object):
 
         # FIXME: This is no good, perhaps, we should only import some variables to internal environment
         self.internals.env.raw.update(self.instruction.raw)
+        if self.instruction.new_root:
+            self.internals.env.real_root = self.instruction.new_root
 
         # Absolute path of the spec file.
         self.internals.env.spec_file = os.path.join(
@@ -397,9 +403,70 @@ class Build(object):
         if not self.instruction.resume_build and len(os.listdir(self.internals.env.install_dir)):
             shelltools.remove_dir(self.internals.env.install_dir)
 
+    def clean_install_dir(self):
+        if os.listdir(self.internals.env.install_dir):
+            shelltools.remove_dir(self.internals.env.install_dir)
+            os.makedirs(self.internals.env.install_dir)
+
+    def install_binary(self, path):
+        '''Prepares the environment to merge a binary package. The image of the
+        package is extracted to install_dir, nothing is fetched or built.'''
+        out.normal("(%s/%s) installing %s/%s from the binary package" % (
+            self.instruction.index,
+            self.instruction.count,
+            out.color(self.internals.env.category, "green"),
+            out.color(self.internals.env.name+"-"+self.internals.env.version, "green"),
+            )
+        )
+        lpms.logger.info("installing %s/%s/%s-%s from %s" % (
+            self.internals.env.repo,
+            self.internals.env.category,
+            self.internals.env.name,
+            self.internals.env.version,
+            path
+            )
+        )
+        self.internals.env.start_time = time.time()
+        self.clean_install_dir()
+        try:
+            metadata = binary.extract(path, self.internals.env.install_dir)
+        except BinaryPackageError as err:
+            out.error(str(err))
+            self.clean_install_dir()
+            return False
+        self.internals.env.binary_package = path
+        self.internals.env.binary_build_info = metadata["build_info"]
+        self.internals.env.prebuilt = True
+        return True
+
     def perform_operation(self):
         '''Handles command line arguments and drive building operation'''
         self.set_environment_variables()
+        # Install the package from the binary package that the resolver has selected
+        if self.binary_package is not None:
+            path = binary.fetch(*self.binary_package)
+            if path is not None and self.install_binary(path):
+                return True, self.internals.env
+            out.warn("the binary package could not be used, building from source")
+
+        # Restore the build if it is in the build cache, a resumed
+        # build keeps its partial image
+        cache = buildcache.build_cache(self.config)
+        if cache is not None and not self.instruction.resume_build:
+            self.clean_install_dir()
+            if buildcache.restore(cache, self.internals.env):
+                out.normal("(%s/%s) restored %s/%s from the build cache" % (
+                    self.instruction.index,
+                    self.instruction.count,
+                    out.color(self.internals.env.category, "green"),
+                    out.color(self.internals.env.name+"-"+self.internals.env.version, "green"),
+                    )
+                )
+                self.internals.env.prebuilt = True
+                self.internals.env.start_time = time.time()
+                return True, self.internals.env
+            # a failed copy may leave a part of the tree
+            self.clean_install_dir()
         # Check /proc and /dev. These filesystems must be mounted 
         # to perform operations properly.
         for item in ('/proc', '/dev'):
@@ -466,7 +533,9 @@ class Build(object):
 
             self.prepare_download_plan(self.internals.env.applied_options)
 
-            if not fetcher.URLFetcher().run(self.download_plan):
+            hashes = os.path.join(cst.repos, self.internals.env.repo, \
+                    self.internals.env.category, self.internals.env.name, "hashes")
+            if not fetcher.URLFetcher().run(self.download_plan, hashes=hashes):
                 lpms.terminate("\nplease check the spec")
 
         if self.internals.env.applied_options is not None and self.internals.env.applied_options:
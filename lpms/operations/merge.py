@@ -16,52 +16,189 @@
 # along with lpms.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import stat
 import time
+import errno
 import gzip
 import shutil
 import shelve
+import decimal
+import hashlib
+import functools
+import subprocess
+import collections
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 import lpms
 
 from lpms import out
 from lpms import conf
+from lpms import elf
+from lpms import binary
+from lpms import buildstats
 from lpms import utils
+from lpms import journal
+from lpms import triggers
 from lpms import internals
 from lpms import shelltools
 from lpms import file_relations
 from lpms import constants as cst
 
 from lpms.db import api
+from lpms.types import PathTree, PathMatcher
+from lpms.exceptions import BuiltinError
+
+executable_bits = stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
+
+# ELF objects and archives that are stripped before the merge
+strip_filetypes = file_relations.binary_filetypes + ('application/x-object',)
+
+# Separated debug information is installed here
+debug_root = "usr/lib/debug"
+
+def file_size(info):
+    '''Returns the size from an lstat result in filesdb format, megabytes as Decimal'''
+    return decimal.Decimal(info.st_size/(1024*1024.0))
+
+def inspect_file(source, binary_filetypes=(), resolver=None):
+    '''Collects what the merge needs to know about a source file. It is
+    called by the workers, so it must not touch the databases. Returns the
+    lstat result, mimetype, shared library dependencies and sha1sum.'''
+    info = os.lstat(source)
+    is_link = stat.S_ISLNK(info.st_mode)
+    mimetype = None; depends = None; sha1 = None
+    if (not is_link and info.st_mode & executable_bits) or \
+            (is_link and os.path.exists(source) and os.access(source, os.X_OK)):
+        mimetype = elf.get_mimetype(source)
+        if mimetype in binary_filetypes:
+            depends = file_relations.get_depends(source, resolver)
+    if not is_link:
+        sha1 = utils.sha1sum(source)
+    return info, mimetype, depends, sha1
+
+def strip_object(task):
+    '''Strips an ELF object or archive. If debug_file is given, the debug
+    information is saved there first and linked to the stripped object.
+    Returns the path and the error message if it is failed.'''
+    path, mimetype, debug_file, tools = task
+    def run(command):
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        if process.returncode != 0:
+            raise OSError(output.strip())
+    flag = "--strip-unneeded" if mimetype in ('application/x-executable', \
+            'application/x-sharedlib') else "--strip-debug"
+    try:
+        if debug_file is not None:
+            if not os.path.isdir(os.path.dirname(debug_file)):
+                os.makedirs(os.path.dirname(debug_file))
+            run([tools["objcopy"], "--only-keep-debug", path, debug_file])
+        run([tools["strip"], flag, path])
+        if debug_file is not None:
+            run([tools["objcopy"], "--add-gnu-debuglink=%s" % debug_file, path])
+    except OSError, err:
+        return path, str(err)
+    return path, None
+
+def compress_file(path, chunk_size=1024*1024):
+    '''Replaces the file with its gzip compressed version'''
+    with open(path, 'rb') as content:
+        output = gzip.open(path+".gz", 'wb')
+        try:
+            shutil.copyfileobj(content, output, chunk_size)
+        finally:
+            output.close()
+    shutil.copymode(path, path+".gz")
+    os.unlink(path)
+
+def copy_tree(source, target):
+    '''Copies a staged tree with its owners and permissions. The data blocks
+    are shared if the filesystem supports it.'''
+    command = [utils.executable_path("cp"), "-a", "--reflink=auto", source, target]
+    process = subprocess.Popen(command, stderr=subprocess.PIPE)
+    error = process.communicate()[1]
+    if process.returncode != 0:
+        raise BuiltinError("[copy_tree] %s could not be copied: %s" % (source, error.strip()))
+
+def move_file(source, target, sha1=None, chunk_size=1024*1024):
+    '''Moves a regular file and returns its sha1sum. The file is renamed
+    if the target is on the same filesystem, otherwise it is copied and
+    hashed in the same read. sha1 is the digest if it is already known.'''
+    try:
+        os.rename(source, target)
+    except OSError, err:
+        if err.errno == errno.ENOENT and not os.path.isdir(os.path.dirname(target)):
+            shelltools.makedirs(os.path.dirname(target))
+            return move_file(source, target, sha1, chunk_size)
+        if err.errno != errno.EXDEV:
+            raise BuiltinError("[move] an error occured while moving: %s -> %s" % (source, target))
+    else:
+        return sha1 if sha1 is not None else utils.sha1sum(target)
+
+    hasher = hashlib.sha1()
+    temporary = target+".lpms-tmp"
+    with open(source, "rb") as source_file:
+        with open(temporary, "wb") as target_file:
+            while True:
+                buf = source_file.read(chunk_size)
+                if not buf:
+                    break
+                hasher.update(buf)
+                target_file.write(buf)
+    shutil.copystat(source, temporary)
+    os.rename(temporary, target)
+    os.unlink(source)
+    return hasher.hexdigest()
 
 class Merge(object):
     '''
     This class performs merge operation and creates database entries for the package
     '''
     def __init__(self, environment):
-        self.symlinks = []
+        self.symlinks = PathTree()
+        self.merged_paths = []
         self.backup = []
         self.environment = environment
         self.instdb = api.InstallDB()
         self.repodb = api.RepositoryDB()
         self.conf = conf.LPMSConfig()
-        self.info_files = []
         self.previous_files = []
         self.filesdb = api.FilesDB()
         self.file_relationsdb = api.FileRelationsDB()
         self.reverse_dependsdb = api.ReverseDependsDB()
-        self.binary_filetypes = ('application/x-executable', 'application/x-archive', \
-                'application/x-sharedlib')
+        # All database writes of the merge are committed in one transaction
+        self.filesdb.attach(self.file_relationsdb, "file_relationsdb")
+        self.filesdb.attach(self.instdb.database, "installdb")
+        if self.environment.image_build:
+            for database in ("main", "file_relationsdb", "installdb"):
+                self.filesdb.cursor.execute('''PRAGMA %s.synchronous = OFF''' % database)
+        self.binary_filetypes = file_relations.binary_filetypes
+        # Libraries are resolved in the target root, lookups are shared by all files
+        self.resolver = elf.Resolver(self.environment.real_root)
         self.merge_conf_file = os.path.join(self.environment.real_root, \
                 cst.merge_conf_file)
-        self.previous_files = self.filesdb.get_paths_by_package(self.environment.name, \
-                repo=self.environment.repo, category=self.environment.category, \
-                version=self.environment.previous_version)
-        # Unfortunately, this seems very ugly :(
-        self.strip_debug_symbols = True if self.environment.no_strip is not None and \
-                ((self.environment.applied_options is not None and \
-                "debug" in self.env.applied_options) or \
-                utils.check_cflags("-g") or utils.check_cflags("-ggdb") \
-                or utils.check_cflags("-g3")) else False
+        # Paths of the installed version in the same slot, if there is one
+        if self.environment.previous_version is not None:
+            self.previous_files = self.filesdb.get_paths_by_package(self.environment.name, \
+                    repo=self.environment.repo, category=self.environment.category, \
+                    version=self.environment.previous_version)
+        self.merge_jobs = int(self.conf.merge_jobs) if hasattr(self.conf, "merge_jobs") \
+                and self.conf.merge_jobs else cpu_count()
+        # Binaries are stripped unless the user or a debug build wants the symbols
+        self.strip_debug_symbols = not self.environment.not_strip and \
+                not (self.environment.applied_options is not None and \
+                "debug" in self.environment.applied_options) and \
+                not (utils.check_cflags("-g") or utils.check_cflags("-ggdb") \
+                or utils.check_cflags("-g3"))
+        self.split_debug = hasattr(self.conf, "split_debug") and self.conf.split_debug
+        # Unchanged files of the previous installation are not rewritten
+        self.delta_merge = hasattr(self.conf, "delta_merge") and self.conf.delta_merge
+        self.previous_states = {}
+        # A fresh root is thrown away if the image build fails, it does not need
+        # durable writes
+        self.journal = journal.Journal(self.environment.real_root, \
+                sync=not self.environment.image_build)
 
     def append_merge_conf(self, item):
         '''Handles merge-conf file'''
@@ -86,9 +223,7 @@ class Merge(object):
             self.merge_conf_data.close()
 
     def is_parent_symlink(self, target):
-        for symlink in self.symlinks:
-            if target.startswith(symlink):
-                return True
+        return self.symlinks.has_parent(target)
 
     def append_filesdb(self, _type, target, perms, **kwargs):
         '''Executes a filesdb query for adding items to files database'''
@@ -99,6 +234,8 @@ class Merge(object):
             gid, mod, uid  = perms['gid'], perms['mod'], perms['uid']
         elif _type == "link":
             gid, mod, uid = None, None, None
+        if _type != "dir":
+            self.merged_paths.append(target)
         self.filesdb.append_query(
                 (self.environment.repo,
                     self.environment.category,
@@ -116,27 +253,127 @@ class Merge(object):
                 )
         )
 
+    def strip_binaries(self):
+        '''Strips the ELF objects in install_dir before the merge. The objects are
+        found in one walk and stripped in parallel. Every inode is stripped once,
+        its other hardlinks are linked to the stripped file again.'''
+        if not self.strip_debug_symbols:
+            return
+        tools = {"strip": utils.executable_path("strip"), \
+                "objcopy": utils.executable_path("objcopy")}
+        if tools["strip"] is None or (self.split_debug and tools["objcopy"] is None):
+            out.warn("binutils could not be found, binaries are not stripped.")
+            return
+        debug_dir = os.path.join(self.environment.install_dir, debug_root)
+        objects = []; inodes = collections.OrderedDict()
+        for parent, directories, files in os.walk(self.environment.install_dir):
+            if parent == debug_dir or parent.startswith(debug_dir+"/"):
+                continue
+            for _file in files:
+                path = os.path.join(parent, _file)
+                info = os.lstat(path)
+                if not stat.S_ISREG(info.st_mode):
+                    continue
+                inode = (info.st_dev, info.st_ino)
+                if inode in inodes:
+                    inodes[inode].append(path)
+                    continue
+                mimetype = elf.get_mimetype(path)
+                if not mimetype in strip_filetypes:
+                    continue
+                inodes[inode] = [path]
+                debug_file = None
+                if self.split_debug and mimetype in ('application/x-executable', \
+                        'application/x-sharedlib'):
+                    debug_file = os.path.join(debug_dir, \
+                            os.path.relpath(path, self.environment.install_dir)+".debug")
+                objects.append((path, mimetype, debug_file, tools))
+        if not objects:
+            return
+
+        out.normal("stripping %d object(s)" % len(objects))
+        pool = ThreadPool(cpu_count())
+        try:
+            for path, error in pool.imap_unordered(strip_object, objects):
+                if error is not None:
+                    out.warn("%s could not be stripped: %s" % (path, error))
+        finally:
+            pool.close()
+            pool.join()
+
+        # strip writes a new file, restore the hardlinks
+        for paths in inodes.values():
+            for path in paths[1:]:
+                os.unlink(path)
+                os.link(paths[0], path)
+
+    def is_unchanged(self, real_target, target, info, sha1):
+        '''Checks the staged file against the filesdb entry of the previous
+        installation and the file in the live root. The live file is not hashed,
+        its size and permissions must match the recorded ones.'''
+        if not real_target in self.previous_states:
+            return False
+        size, gid, mod, uid, sha1sum = self.previous_states[real_target]
+        if sha1 != sha1sum or file_size(info) != size or \
+                (str(info.st_gid), str(stat.S_IMODE(info.st_mode)), str(info.st_uid)) \
+                != (str(gid), str(mod), str(uid)):
+            return False
+        try:
+            target_info = os.lstat(target)
+        except OSError:
+            return False
+        return stat.S_ISREG(target_info.st_mode) and \
+                target_info.st_size == info.st_size and \
+                target_info.st_uid == info.st_uid and \
+                target_info.st_gid == info.st_gid and \
+                stat.S_IMODE(target_info.st_mode) == stat.S_IMODE(info.st_mode)
+
     def merge_package(self):
         '''Moves files to the target destination in the most safest way.'''
-        def get_perms(path):
-            '''Get permissions of given path, it may be file or directory'''
-            return {"uid": utils.get_uid(path),
-                    "gid": utils.get_gid(path),
-                    "mod": utils.get_mod(path)
+        def get_perms(info):
+            '''Get permissions from the lstat result of a file or directory'''
+            return {"uid": info.st_uid,
+                    "gid": info.st_gid,
+                    "mod": stat.S_IMODE(info.st_mode)
             }
         out.normal("%s/%s/%s-%s:%s is merging to %s" % (self.environment.repo, self.environment.category, \
                 self.environment.name, self.environment.version, self.environment.slot, \
                 self.environment.real_root))
-        # Remove files db entries for this package:slot if it exists
-        self.filesdb.delete_item_by_pkgdata(self.environment.category, self.environment.name, \
-            self.environment.previous_version, commit=True)
-
-        # Remove file_relations db entries for this package:slot if it exists
-        self.file_relationsdb.delete_item_by_pkgdata(self.environment.category, \
-                self.environment.name, self.environment.previous_version, commit=True)
+        # Every change in the live root is recorded before it is done
+        self.journal.begin("%s/%s/%s-%s:%s" % (self.environment.repo, self.environment.category, \
+                self.environment.name, self.environment.version, self.environment.slot))
+        if self.delta_merge:
+            self.previous_states = dict([(item[0], item[1:]) for item in \
+                    self.filesdb.get_file_states_by_package(self.environment.category, \
+                    self.environment.name, self.environment.previous_version)])
+        if self.environment.previous_version is not None:
+            # Remove files db entries for this package:slot if it exists
+            self.filesdb.delete_item_by_pkgdata(self.environment.category, self.environment.name, \
+                self.environment.previous_version)
+
+            # Remove file_relations db entries for this package:slot if it exists
+            self.file_relationsdb.delete_item_by_pkgdata(self.environment.category, \
+                    self.environment.name, self.environment.previous_version)
 
         # Merge the package, now
-        walk_iter = os.walk(self.environment.install_dir, followlinks=True)
+        # The tree is listed before anything is moved. Files are inspected by a pool
+        # of workers ahead of the merge loop, directories are created and files are
+        # moved by this thread in the walk order. The symlinked directories are
+        # listed in their parents but not followed, their content is merged
+        # from the real directories.
+        walk = list(os.walk(self.environment.install_dir))
+        pool = ThreadPool(self.merge_jobs)
+        inspections = pool.imap(functools.partial(inspect_file, \
+                binary_filetypes=self.binary_filetypes, resolver=self.resolver), \
+                [os.path.join(parent, _file) for parent, directories, files in walk for _file in files], \
+                chunksize=16)
+        # Reserved files are read once and compiled for the whole walk
+        if self.environment.ignore_reserve_files:
+            reserve_files = PathMatcher()
+            self.environment.reserve_files = True
+        else:
+            reserve_files = utils.reserve_files_matcher(self.environment.reserve_files)
+        walk_iter = iter(walk)
         while True:
             try:
                 parent, directories, files = next(walk_iter)
@@ -146,146 +383,123 @@ class Merge(object):
                 # create directories
                 for directory in directories:
                     source = os.path.join(parent, directory)
-                    target = os.path.join(self.environment.real_root, pruned_parent, directory)
+                    target = os.path.join(self.environment.real_root, pruned_parent[1:], directory)
                     real_target = "/".join([pruned_parent, directory])
                     if self.is_parent_symlink(target):
                         break
-                    if os.path.islink(source):
-                        self.symlinks.append(target+"/")
+                    info = os.lstat(source)
+                    if stat.S_ISLNK(info.st_mode):
+                        self.symlinks.add(target)
                         realpath = os.path.realpath(source)
-                        if os.path.islink(target):
-                            shelltools.remove_file(target)
                         # create real directory
                         if len(realpath.split(self.environment.install_dir)) > 1:
                             realpath = realpath.split(self.environment.install_dir)[1][1:]
 
                         shelltools.makedirs(os.path.join(self.environment.real_root, realpath))
-                        # make symlink
-                        if os.path.isdir(target):
-                            shelltools.remove_dir(target)
-                        elif os.path.isfile(target):
-                            shelltools.remove_file(target)
+                        # make symlink, the link, directory or file that is
+                        # in the way is kept until the merge is done
+                        self.journal.set_aside(target)
                         shelltools.make_symlink(os.readlink(source), target)
+                        # Add the item to filesdb, symlinks have no permissions
+                        self.append_filesdb("link", real_target, None, \
+                                realpath=os.path.realpath(source))
                     else:
                         if os.path.isfile(target):
                             # TODO: Rename this file and warn the user
-                            shelltools.remove_file(target)
+                            self.journal.set_aside(target)
+                        if not os.path.isdir(target):
+                            self.journal.mkdir(target)
                         shelltools.makedirs(target)
-                    # Get permissions
-                    perms = get_perms(source)
-                    # if path is a symlink, pass permission mumbo-jumbos
-                    if not os.path.islink(source):
+                        perms = get_perms(info)
                         # Set permissions
                         shelltools.set_id(target, perms["uid"], perms["gid"])
                         shelltools.set_mod(target, perms["mod"])
                         # TODO: Common items?
                         # Add the item to filesdb
                         self.append_filesdb("dir", real_target, perms)
-                    else:
-                        # Add the item to filesdb
-                        self.append_filesdb("link", real_target, perms, \
-                                realpath=os.path.realpath(source))
 
                 # Merge regular files to the target
-                # Firstly, handle reserved files
-                reserve_files = []
-                if self.environment.reserve_files:
-                    if isinstance(self.environment.reserve_files, basestring):
-                        reserve_files.extend([f_item for f_item in self.environment.reserve_files.split(" ") \
-                                if f_item != ""])
-                    elif isinstance(self.environment.reserve_files, list) or isinstance(self.environment.reserve_files, tuple):
-                        reserve_files.extend(self.environment.reserve_files)
-
-                if os.path.isfile(os.path.join(cst.user_dir, cst.protect_file)):
-                    with open(os.path.join(cst.user_dir, cst.protect_file)) as data:
-                        for rf in data.readlines():
-                            if not rf.startswith("#"):
-                                reserve_files.append(rf.strip())
-
                 # Here we are starting to merge
-                for _file in files:
+                # The inspection results come in the order of the files
+                inspected = [next(inspections) for _file in files]
+                for _file, (info, mimetype, depends, sha1) in zip(files, inspected):
                     source = os.path.join(parent, _file)
-                    target = os.path.join(self.environment.real_root, pruned_parent, _file)
+                    target = os.path.join(self.environment.real_root, pruned_parent[1:], _file)
                     real_target = "/".join([pruned_parent, _file])
                     if self.is_parent_symlink(target):
                         break
+                    is_link = stat.S_ISLNK(info.st_mode)
                     # Keep file relations for using after to handle reverse dependencies
-                    if os.path.exists(source) and os.access(source, os.X_OK):
-                        if utils.get_mimetype(source) in self.binary_filetypes:
-                            self.file_relationsdb.append_query((
-                                self.environment.repo,
-                                self.environment.category,
-                                self.environment.name,
-                                self.environment.version,
-                                target,
-                                file_relations.get_depends(source))
-                            )
-                    # Strip binary files and keep them smaller
-                    if self.strip_debug_symbols and utils.get_mimetype(source) in self.binary_filetypes:
-                        utils.run_strip(source)
-                    if self.environment.ignore_reserve_files:
-                        reserve_files = []
-                        self.environment.reserve_files = True
-
-                    def add_file_item():
-                        # Prevent code duplication
-                        if not os.path.islink(target):
-                            shelltools.set_id(target, perms["uid"], perms["gid"])
-                            shelltools.set_mod(target, perms["mod"])
-                            self.append_filesdb("file", real_target, perms, \
-                                    sha1sum=utils.sha1sum(target),
-                                    size = utils.get_size(source, dec=True)
-                            )
-                        else:
-                            self.append_filesdb("link", real_target, perms,\
-                                    realpath=os.path.realpath(source))
-
+                    if depends is not None:
+                        self.file_relationsdb.append_query((
+                            self.environment.repo,
+                            self.environment.category,
+                            self.environment.name,
+                            self.environment.version,
+                            target,
+                            depends)
+                        )
                     if self.environment.reserve_files is not False:
-                        conf_file = os.path.join(pruned_parent, _file)
-                        isconf = (_file.endswith(".conf") or _file.endswith(".cfg"))
-                        def is_reserve():
-                            if self.environment.ignore_reserve_files:
-                                return False
-                            elif not conf_file in reserve_files:
-                                return False
-                            return True
-
-                        if os.path.exists(target) and not is_reserve():
-                            if pruned_parent[0:4] == "/etc" or isconf:
-                                if os.path.isfile(conf_file) and utils.sha1sum(source) != utils.sha1sum(conf_file):
-                                    self.append_merge_conf(conf_file)
-                                    target = target+".lpms-backup" 
-                                    self.backup.append(target)
-
-                        if os.path.exists(target) and is_reserve():
-                            # The file is reserved.
-                            # Adds to filesdb
-                            add_file_item()
+                        if os.path.lexists(target) and reserve_files.match(real_target):
+                            # The file is reserved. It is kept as it is and
+                            # added to filesdb with its own attributes.
+                            reserved_info = os.lstat(target)
+                            if stat.S_ISLNK(reserved_info.st_mode):
+                                self.append_filesdb("link", real_target, None, \
+                                        realpath=os.path.realpath(source))
+                            else:
+                                self.append_filesdb("file", real_target, get_perms(reserved_info), \
+                                        sha1sum=utils.sha1sum(target),
+                                        size=file_size(reserved_info))
                             # We don't need the following operations
                             continue
 
-                    if os.path.islink(source):
-                        sha1 = False
+                        isconf = (_file.endswith(".conf") or _file.endswith(".cfg"))
+                        if (pruned_parent[0:4] == "/etc" or isconf) and os.path.isfile(target):
+                            if sha1 is None:
+                                sha1 = utils.sha1sum(source)
+                            if sha1 != utils.sha1sum(target):
+                                self.append_merge_conf(real_target)
+                                target = target+".lpms-backup"
+                                self.backup.append(target)
+
+                    if is_link:
                         realpath = os.readlink(source)
                         if self.environment.install_dir in realpath:
                             realpath = realpath.split(self.environment.install_dir)[1]
 
-                        if os.path.isdir(target):
-                            shelltools.remove_dir(target)
-                        elif os.path.isfile(target) or os.path.islink(target):
-                            shelltools.remove_file(target)
-                        shelltools.make_symlink(realpath, target)
+                        if os.path.isdir(target) and not os.path.islink(target):
+                            # the directory is kept until the merge is done
+                            self.journal.set_aside(target)
+                        # The link is staged and renamed over the target with the files
+                        shelltools.make_symlink(realpath, self.journal.stage(target))
+                        self.append_filesdb("link", real_target, None, \
+                                realpath=os.path.realpath(source))
                     else:
-                        sha1 = utils.sha1sum(source)
-                        perms = get_perms(source)
-                        shelltools.move(source, target)
-                    # Adds to filesdb
-                    add_file_item()
+                        perms = get_perms(info)
+                        if self.delta_merge and not target in self.backup and \
+                                self.is_unchanged(real_target, target, info, sha1):
+                            # The live file is already the same, only its entry is renewed
+                            self.append_filesdb("file", real_target, perms, \
+                                    sha1sum=sha1, size=file_size(info))
+                            continue
+                        staged = self.journal.stage(target)
+                        sha1 = move_file(source, staged, sha1)
+                        shelltools.set_id(staged, perms["uid"], perms["gid"])
+                        shelltools.set_mod(staged, perms["mod"])
+                        # Adds to filesdb
+                        self.append_filesdb("file", real_target, perms, \
+                                sha1sum=sha1, size=file_size(info))
             except StopIteration as err:
                 break
+        pool.close()
+        pool.join()
 
-        self.file_relationsdb.insert_query(commit=True)
-        self.filesdb.insert_query(commit=True)
+        # All files are staged next to their targets, replace the targets now
+        self.journal.install()
+
+        self.file_relationsdb.insert_query(commit=False)
+        self.filesdb.insert_query()
 
         lpms.logger.info("%s/%s has been merged to %s." % (self.environment.category, self.environment.fullname, \
                 self.environment.real_root))
@@ -309,25 +523,19 @@ class Merge(object):
         
         if installed_package:
             package_id = self.environment.package.package_id = installed_package.get(0).id
-            self.instdb.update_package(self.environment.package, commit=True)
+            self.instdb.update_package(self.environment.package)
         else:
-            self.instdb.insert_package(self.environment.package, commit=True)
-            package_id = self.instdb.find_package(
-                    package_repo=self.environment.package.repo,
-                    package_category=self.environment.package.category,
-                    package_name=self.environment.package.name,
-                    package_version=self.environment.package.version
-            ).get(0).id
+            package_id = self.instdb.insert_package(self.environment.package)
 
         # Create or update inline_options table entries.
         if self.environment.inline_option_targets is not None:
             for target in self.environment.inline_option_targets:
                 if self.instdb.find_inline_options(package_id=package_id, target=target):
                     self.instdb.update_inline_options(package_id, target, \
-                            self.environment.inline_option_targets[target])
+                            self.environment.inline_option_targets[target], commit=False)
                 else:
                     self.instdb.insert_inline_options(package_id, target, \
-                            self.environment.inline_option_targets[target])
+                            self.environment.inline_option_targets[target], commit=False)
 
         # Create or update conditional_versions table entries.
         if self.environment.conditional_versions is not None:
@@ -336,106 +544,128 @@ class Merge(object):
                 del decision_point["target"]
                 if not self.instdb.find_conditional_versions(package_id=package_id, target=target):
                     self.instdb.insert_conditional_versions(package_id, target, \
-                            decision_point)
+                            decision_point, commit=False)
                 else:
                     self.instdb.update_conditional_versions(package_id, target, \
-                            decision_point)
+                            decision_point, commit=False)
 
-        self.instdb.database.delete_build_info(package_id)
+        self.instdb.database.delete_build_info(package_id, commit=False)
         
         # requestor values are temporary
         # TODO: requestor and related fields are going to be removed 
         requestor = os.getenv("USER")
         requestor_id = os.getuid()
-        end_time = time.time()
-        host = os.environ["HOST"] if "HOST" in os.environ else ""
-        cflags = os.environ["CFLAGS"] if "CFLAGS" in os.environ else ""
-        cxxflags = os.environ["CXXFLAGS"] if "CXXFLAGS" in os.environ else ""
-        ldflags = os.environ["LDFLAGS"] if "LDFLAGS" in os.environ else "" 
-        jobs = os.environ["JOBS"] if "JOBS" in os.environ else ""
-        cc = os.environ["CC"] if "CC" in os.environ else ""
-        cxx = os.environ["CXX"] if "CXX" in os.environ else ""
+        # Binary packages carry the build info of the host that has built them
+        build_info = self.environment.binary_build_info
+        if build_info is None:
+            build_info = binary.build_info()
+            build_info["start_time"] = self.environment.start_time
         self.instdb.database.insert_build_info(
                 package_id, 
-                self.environment.start_time,
-                end_time,
+                build_info["start_time"],
+                build_info["end_time"],
                 requestor,
                 requestor_id,
-                host,
-                cflags,
-                cxxflags,
-                ldflags,
-                jobs,
-                cc,
-                cxx,
+                build_info["host"],
+                build_info["cflags"],
+                build_info["cxxflags"],
+                build_info["ldflags"],
+                build_info["jobs"],
+                build_info["cc"],
+                build_info["cxx"],
+                commit=False
         )
+        # Recovery completes the merge instead of rolling it back if the id is committed
+        self.instdb.database.mark_merge(self.journal.id, commit=False)
+        self.package_id = package_id
+        self.instdb.database.delete_build_stats(package_id, commit=False)
+        if self.environment.stage_stats:
+            self.instdb.database.insert_build_stats(package_id, \
+                    self.environment.stage_stats, commit=False)
 
     def clean_obsolete_content(self):
         '''Cleans obsolete content which belogs to previous installs'''
-        if self.instdb.find_package(package_name=self.environment.name, \
-                package_category=self.environment.category,
-                package_slot=self.environment.slot):
-            obsolete = self.compare_different_versions()
-            if not obsolete:
-                return
-            out.normal("cleaning obsolete content")
-            directories = []
-            for item in obsolete:
-                target = os.path.join(self.environment.real_root, item[0][1:])
-                if not os.path.exists(target):
-                    continue
-                if os.path.islink(target):
+        if not self.previous_files:
+            return
+        obsolete = self.compare_different_versions()
+        if not obsolete:
+            return
+        out.normal("cleaning obsolete content")
+        directories = []
+        for item in obsolete:
+            target = os.path.join(self.environment.real_root, item[1:])
+            try:
+                info = os.lstat(target)
+            except OSError:
+                continue
+            if stat.S_ISDIR(info.st_mode):
+                directories.append(target)
+            else:
+                try:
                     os.unlink(target)
-                elif os.path.isfile(target):
-                    shelltools.remove_file(target)
-                else:
-                    directories.append(target)
-
-            directories.reverse()
-            for directory in directories:
-                if not os.listdir(directory):
-                    # Remove directory if it does not include anything
-                    shelltools.remove_dir(directory)
+                except OSError, err:
+                    out.warn("%s could not be removed: %s" % (target, err.strerror))
+
+        # Remove the directories bottom-up if they do not include anything.
+        # The merge is already committed, a directory that can not be
+        # removed, like a mountpoint, is left in place.
+        directories.sort(key=lambda directory: directory.count("/"), reverse=True)
+        for directory in directories:
+            try:
+                os.rmdir(directory)
+            except OSError, err:
+                if not err.errno in (errno.ENOTEMPTY, errno.EEXIST):
+                    out.warn("%s could not be removed: %s" % (directory, err.strerror))
 
     def compare_different_versions(self):
         '''Compares file lists of different installations of the same package and finds obsolete content'''
-        current_files = self.filesdb.get_paths_by_package(self.environment.name, \
-                        repo=self.environment.repo, category=self.environment.category, version=self.environment.version)
-        obsolete = []
-        for item in self.previous_files:
-            if not item in current_files:
-                obsolete.append(item)
-        return obsolete
+        current_files = set([item[0] for item in self.filesdb.get_paths_by_package(self.environment.name, \
+                repo=self.environment.repo, category=self.environment.category, \
+                version=self.environment.version)])
+        return [item[0] for item in self.previous_files if not item[0] in current_files]
 
     def create_info_archive(self):
+        '''Compresses the info pages of the package in parallel'''
         info_path = os.path.join(self.environment.install_dir, cst.info)
         if not os.path.isdir(info_path): return
-        for item in os.listdir(os.path.join(self.environment.install_dir, cst.info)):
-            info_file = os.path.join(info_path, item)
-            with open(info_file, 'rb') as content:
-                with gzip.open(info_file+".gz", 'wb') as output:
-                    output.writelines(content)
-                    self.info_files.append(os.path.join(self.environment.real_root, cst.info, item)+".gz")
-            shelltools.remove_file(info_file)
-
-    def update_info_index(self):
-        for info_file in self.info_files:
-            if os.path.exists(info_file):
-                utils.update_info_index(info_file)
+        info_files = [os.path.join(info_path, item) for item in os.listdir(info_path) \
+                if item != "dir" and not item.endswith(".gz") and \
+                os.path.isfile(os.path.join(info_path, item))]
+        if not info_files: return
+        pool = ThreadPool(min(self.merge_jobs, len(info_files)))
+        try:
+            pool.map(compress_file, info_files)
+        finally:
+            pool.close()
+            pool.join()
 
     def perform_operation(self):
         utils.xterm_title("(%s/%s) lpms: merging %s/%s-%s from %s" % (self.environment.index, self.environment.count, 
             self.environment.category, self.environment.name, self.environment.version, self.environment.repo))
-        # create $info_file_name.gz archive and remove info file
-        self.create_info_archive()
-        # merge the package
-        self.merge_package()
+        with buildstats.measure(self.environment, "strip"):
+            # create $info_file_name.gz archive and remove info file
+            self.create_info_archive()
+            # strip the binaries before they are hashed and merged
+            self.strip_binaries()
+        try:
+            # the whole merge transaction is measured, its row is written after the commit
+            with buildstats.measure(self.environment, "merge"):
+                # merge the package
+                self.merge_package()
+                # write to database
+                self.write_db()
+                self.filesdb.commit()
+        except:
+            # leave the live root and the databases as they were before the merge
+            self.filesdb.connection.rollback()
+            self.journal.rollback()
+            raise
+        self.journal.finish()
+        self.instdb.database.insert_build_stats(self.package_id, self.environment.stage_stats[-1:])
         # clean the previous version if it is exists
         self.clean_obsolete_content()
-        # write to database
-        self.write_db()
-        # create or update /usr/share/info/dir 
-        self.update_info_index()
+        # info pages, the library cache etc. are updated at the end of the plan
+        triggers.TriggerQueue().add_package(self.environment, self.merged_paths)
 
         if self.backup:
             out.write("%s%s configuration file changed. Use %s to fix these files.\n" % 
@@ -26,6 +26,7 @@ import lpms
 from lpms import out
 from lpms import conf
 from lpms import utils
+from lpms import binary
 from lpms import sorter
 from lpms import constants as cst
 
@@ -52,11 +53,13 @@ class DependencyResolver(object):
     def __init__(self, packages,
             command_line_options=[],
             custom_options={},
-            use_new_options=False):
+            use_new_options=False,
+            use_binary=False):
         self.packages = packages
         self.command_line_options = command_line_options
         self.custom_options = custom_options
         self.use_new_options = use_new_options
+        self.use_binary = use_binary
         self.conflicts = {}
         self.current_package = None
         self.parent_package = None
@@ -617,6 +620,28 @@ class DependencyResolver(object):
                             self.conflict_point = conflict_point
                             raise ConditionConflict(conflict_point)
 
+    def select_binary_packages(self, packages):
+        '''Finds the binary packages that can be installed instead of building
+        the packages of the plan. Their dependencies must have the versions
+        that are going to be installed.'''
+        binaries = {}
+        if not self.use_binary:
+            return binaries
+        index = binary.BinaryIndex()
+        planned = dict([((package.category, package.name, package.slot), package.version) \
+                for package in packages])
+        def versions(category, name, slot):
+            if (category, name, slot) in planned:
+                return planned[(category, name, slot)]
+            installed_package = self.instdb.find_package(package_name=name, \
+                    package_category=category, package_slot=slot)
+            return installed_package.get(0).version if installed_package else None
+        for package in packages:
+            match = index.match(package, self.package_options.get(package.id), versions)
+            if match is not None:
+                binaries[package.id] = match
+        return binaries
+
     def create_operation_plan(self):
         '''Resolve dependencies and prepares a convenient operation plan'''
         single_packages = PackageItem()
@@ -732,6 +757,9 @@ class DependencyResolver(object):
             result.inline_option_targets = self.inline_option_targets
             result.conditional_versions = self.conditional_versions
             result.conflicts = self.conflicts
+            result.binaries = self.select_binary_packages(self.packages)
+            # The given order is kept
+            result.package_query = None
             return result
 
         # Workaround for postmerge dependencies
@@ -865,4 +893,9 @@ class DependencyResolver(object):
         operation_plan.inline_option_targets = self.inline_option_targets
         operation_plan.conditional_versions = self.conditional_versions
         operation_plan.conflicts = self.conflicts
+        operation_plan.binaries = self.select_binary_packages(final_plan)
+        # The plan may have a conditional version instead of the package of a pair,
+        # the pairs are given by the package keys to order the plan
+        operation_plan.package_query = [(self.package_heap[dependency].pk, self.package_heap[package].pk) \
+                for dependency, package in self.package_query]
         return operation_plan
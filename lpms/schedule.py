@@ -0,0 +1,135 @@
+# Copyright 2009 - 2011 Burak Sezer <purak@hadronproject.org>
+#
+# This file is part of lpms
+#
+# lpms is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# lpms is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with lpms.  If not, see <http://www.gnu.org/licenses/>.
+
+# Orders the operation plan by the build durations that installdb keeps.
+# The packages on the longest chain of builds are started first, the
+# dependency pairs keep the order that the resolver has given them.
+
+import heapq
+
+from lpms import utils
+
+# The stages that run when a package is installed from a binary package
+binary_stages = ("post_install", "strip", "merge")
+
+class BuildHistory(object):
+    '''Estimates the durations of the planned operations from the
+    previous installs of the packages'''
+    def __init__(self, instdb, binaries=None):
+        self.instdb = instdb
+        self.binaries = binaries or {}
+
+    def previous_install(self, package):
+        installed_packages = self.instdb.find_package(package_name=package.name, \
+                package_category=package.category)
+        if not installed_packages:
+            return None
+        same_slot = [item for item in installed_packages if item.slot == package.slot]
+        if same_slot:
+            installed_packages = same_slot
+        return sorted(installed_packages, \
+                cmp=lambda x, y: utils.vercmp(x.version, y.version))[-1]
+
+    def estimate(self, package):
+        '''Returns the estimated seconds or None if there is no history'''
+        installed_package = self.previous_install(package)
+        if installed_package is None:
+            return None
+        stats = self.instdb.database.get_build_stats(installed_package.id)
+        if package.id in self.binaries:
+            if not stats:
+                return None
+            return sum([item[1] for item in stats if item[0] in binary_stages])
+        if [item for item in stats if item[0] not in binary_stages]:
+            return sum([item[1] for item in stats])
+        # The package was installed from a binary package or before the stages
+        # were measured, build_info has the duration of the whole build.
+        build_info = self.instdb.database.get_package_build_info(installed_package.id)
+        if build_info is None or not build_info[1] or not build_info[2]:
+            return None
+        return max(build_info[2] - build_info[1], 0)
+
+    def estimates(self, packages):
+        return dict([(package.id, self.estimate(package)) for package in packages])
+
+def order(packages, package_query, estimates):
+    '''Reorders the plan so that the ready package with the longest chain of
+    builds after it comes first. package_query is the list of (dependency,
+    package) pairs of the resolver as package keys (category/name/slot), the
+    plan may have another version of a package than the pairs. The packages
+    that are not planned are followed to find the indirect pairs.'''
+    position = dict([(package.pk, index) for index, package in enumerate(packages)])
+    graph = {}
+    for dependency, package in package_query:
+        if dependency != package:
+            graph.setdefault(dependency, set()).add(package)
+
+    successors = {}
+    for package in packages:
+        found, stack, seen = set(), list(graph.get(package.pk, ())), set()
+        while stack:
+            item = stack.pop()
+            if item in seen:
+                continue
+            seen.add(item)
+            if item in position:
+                found.add(item)
+            else:
+                stack.extend(graph.get(item, ()))
+        successors[package.pk] = found
+
+    # Every pair keeps the direction of the current plan, so the postmerge
+    # dependencies stay after their packages and no cycle is introduced.
+    edges = {}
+    parents = dict([(package.pk, 0) for package in packages])
+    for first in successors:
+        for second in successors[first]:
+            if first == second:
+                continue
+            if position[first] > position[second]:
+                first, second = second, first
+            if second in edges.setdefault(first, set()):
+                continue
+            edges[first].add(second)
+            parents[second] += 1
+
+    # The length of the longest chain of builds that starts with the package
+    priority = {}
+    for package in reversed(packages):
+        priority[package.pk] = (estimates.get(package.id) or 0) + \
+                max([priority[item] for item in edges.get(package.pk, ())] or [0])
+
+    ready = [(-priority[package.pk], position[package.pk]) for package in packages \
+            if not parents[package.pk]]
+    heapq.heapify(ready)
+    result = packages.__class__()
+    while ready:
+        index = heapq.heappop(ready)[1]
+        result.append(packages[index])
+        for item in edges.get(packages[index].pk, ()):
+            parents[item] -= 1
+            if not parents[item]:
+                heapq.heappush(ready, (-priority[item], position[item]))
+    return result
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return "%ds" % seconds
+    if seconds < 3600:
+        return "%dm %02ds" % (seconds // 60, seconds % 60)
+    return "%dh %02dm" % (seconds // 3600, (seconds % 3600) // 60)
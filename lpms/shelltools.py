@@ -18,9 +18,14 @@
 import os
 import sys
 import glob
+import pipes
+import select
 import shutil
 import time
+import tempfile
+import threading
 import subprocess
+from contextlib import contextmanager
 
 import lpms 
 from lpms import out
@@ -103,25 +108,54 @@ def touch(path):
         return
     open(path, 'w').close()
 
-def system(cmd, show=False, stage=None, sandbox=None):
-    cfg = conf.LPMSConfig()
-    if sandbox is None:
+# system() is called for every command of a spec, so its settings are read once
+system_settings = None
+
+def get_system_settings():
+    global system_settings
+    if system_settings is None:
+        cfg = conf.LPMSConfig()
         sandbox = True if cfg.sandbox else False
         # override 'sandbox' variable if the user wants to modifiy from cli
-        if lpms.getopt('--enable-sandbox'): 
+        if lpms.getopt('--enable-sandbox'):
             sandbox = True
         elif lpms.getopt('--disable-sandbox'):
             sandbox = False
-    if lpms.getopt("--verbose"):
+        # FIXME: getopt should not do this.
+        # the verbosity of messages, defaults to 1
+        # 1 - error
+        # 2 - warning
+        # 3 - normal
+        # 4 - verbose
+        # 5 - debug
+        # 6 - crazy debug
+        log_level = lpms.getopt("--sandbox-log-level", like=True)
+        if log_level is None:
+            log_level = "1"
+        if not log_level in ('1', '2', '3', '4', '5', '6'):
+            out.warn("%s is an invalid sandbox log level." % log_level)
+        system_settings = {
+                "sandbox": sandbox,
+                "sandbox_log_level": log_level,
+                "sandbox_session": hasattr(cfg, "sandbox_session") and cfg.sandbox_session is True,
+                "verbose": lpms.getopt("--verbose"),
+                "quiet": not cfg.print_output or lpms.getopt("--quiet")
+        }
+    return system_settings
+
+def system(cmd, show=False, stage=None, sandbox=None):
+    settings = get_system_settings()
+    if sandbox is None:
+        sandbox = settings["sandbox"]
+    if settings["verbose"]:
         ret, output, err = run_cmd(cmd, True)
-    elif (not cfg.print_output or lpms.getopt("--quiet")) \
-            and not show:
-                ret, output, err = run_cmd(cmd, show=False, enable_sandbox=sandbox)
+    elif settings["quiet"] and not show:
+        ret, output, err = run_cmd(cmd, show=False, enable_sandbox=sandbox)
     else:
         ret, output, err = run_cmd(cmd, show=True, enable_sandbox=sandbox)
 
     if ret != 0:
-        if not conf.LPMSConfig().print_output or lpms.getopt("--quiet"): 
+        if settings["quiet"]:
             out.brightred("\n>> error messages:\n")
             out.write(err)
         out.warn("command failed: %s" % out.color(cmd, "red"))
@@ -130,30 +164,152 @@ def system(cmd, show=False, stage=None, sandbox=None):
         return False
     return True
 
+def sandbox_arguments(log_level):
+    return [cst.sandbox_app, "--config=%s" % cst.sandbox_config, "--log-level=%s" % log_level, \
+            "--log-file=%s" % cst.sandbox_log, "--"]
+
 def run_cmd(cmd, show=True, enable_sandbox=True):
     stdout = None; stderr = None
     if enable_sandbox:
-        # FIXME: getopt should not do this.
-        # the verbosity of messages, defaults to 1
-        # 1 - error
-        # 2 - warning
-        # 3 - normal
-        # 4 - verbose
-        # 5 - debug
-        # 6 - crazy debug
-        log_level = lpms.getopt("--sandbox-log-level", like=True)
-        if log_level is None:
-            log_level = "1"
-        if not log_level in ('1', '2', '3', '4', '5', '6'):
-            out.warn("%s is an invalid sandbox log level." % log_level)
-        cmd = "%s --config=%s --log-level=%s --log-file=%s -- %s" % (cst.sandbox_app, cst.sandbox_config, \
-                log_level, cst.sandbox_log, cmd)
+        current_session = start_session()
+        if current_session is not None and current_session.is_alive():
+            return current_session.run(cmd, show)
+        cmd = " ".join(sandbox_arguments(get_system_settings()["sandbox_log_level"])+[cmd])
     if not show:
         stdout = subprocess.PIPE; stderr=subprocess.PIPE
     result = subprocess.Popen(cmd, shell=True, stdout=stdout, stderr=stderr)
     output, err = result.communicate()
     return result.returncode, output, err
 
+class SandboxSession(object):
+    '''A sandboxed shell that runs the commands one by one. It is started once,
+    so the commands do not pay the startup of the sandbox. Every command runs
+    in its own /bin/sh -c, in the current directory and environment of lpms.'''
+    # The shell reads a line for every command from the commands fifo, runs
+    # $1/command and writes its exit status to the status fifo.
+    loop = '''exec 3<"$1/commands" 4>"$1/status"
+while IFS= read -r mode <&3; do
+    case "$mode" in
+        capture) ( . "$1/command" ) 3<&- 4>&- >"$1/stdout" 2>"$1/stderr" ;;
+        show) ( . "$1/command" ) 3<&- 4>&- ;;
+        *) break ;;
+    esac
+    echo $? >&4
+done'''
+
+    def __init__(self, log_level):
+        # The files must be writable in the sandbox
+        self.directory = tempfile.mkdtemp(prefix="sandbox-", dir=cst.extract_dir)
+        self.lock = threading.Lock()
+        self.environment = dict(os.environ)
+        self.process = None
+        self.commands = None
+        self.status = None
+        try:
+            for name in ("commands", "status"):
+                os.mkfifo(os.path.join(self.directory, name), 0600)
+            self.process = subprocess.Popen(sandbox_arguments(log_level)+["/bin/sh", "-c", \
+                    self.loop, "lpms-sandbox", self.directory])
+            # Opening the fifos for both reading and writing does not block
+            # and they are not closed if the shell dies.
+            self.commands = os.open(os.path.join(self.directory, "commands"), os.O_RDWR)
+            self.status = os.open(os.path.join(self.directory, "status"), os.O_RDWR)
+        except:
+            self.close()
+            raise
+
+    def is_alive(self):
+        return self.status is not None and self.process.poll() is None
+
+    def script(self, cmd):
+        '''Returns the script that runs the command like a new process of lpms would.
+        The changes of the environment are applied by env(1), so the variables
+        whose names are not valid in the shell are passed too.'''
+        arguments = ["env"]
+        for key in self.environment:
+            if not key in os.environ:
+                arguments.extend(["-u", key])
+        for key, value in os.environ.items():
+            if self.environment.get(key) != value:
+                arguments.append("%s=%s" % (key, value))
+        arguments.extend(["/bin/sh", "-c", cmd])
+        return "cd %s || exit 1\nexec %s\n" % (pipes.quote(os.getcwd()), \
+                " ".join([pipes.quote(argument) for argument in arguments]))
+
+    def run(self, cmd, show=True):
+        '''Runs the command, returns its exit status and the output like run_cmd'''
+        with self.lock:
+            with open(os.path.join(self.directory, "command"), "w") as command:
+                command.write(self.script(cmd))
+            sys.stdout.flush(); sys.stderr.flush()
+            os.write(self.commands, "show\n" if show else "capture\n")
+            status = ""
+            while not status.endswith("\n"):
+                if not select.select([self.status], [], [], 1)[0]:
+                    if self.process.poll() is not None:
+                        raise exceptions.BuiltinError("the sandbox session has been terminated.")
+                    continue
+                status += os.read(self.status, 16)
+            if show:
+                return int(status), None, None
+            result = [int(status)]
+            for name in ("stdout", "stderr"):
+                with open(os.path.join(self.directory, name)) as data:
+                    result.append(data.read())
+            return tuple(result)
+
+    def close(self):
+        if self.commands is not None:
+            if self.process.poll() is None:
+                os.write(self.commands, "exit\n")
+                self.process.wait()
+            os.close(self.commands)
+            os.close(self.status)
+            self.commands = self.status = None
+        elif self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+# The session that runs the sandboxed commands of the current stage. It is
+# started by the first sandboxed command in a session() block.
+sandbox_session = None
+in_session = False
+# Set if the session could not be started, it is not tried again
+session_failed = False
+
+def start_session():
+    '''Returns the session of the current block, starts it if it is needed'''
+    global sandbox_session, session_failed
+    if sandbox_session is not None or not in_session or session_failed:
+        return sandbox_session
+    settings = get_system_settings()
+    if not settings["sandbox"] or not settings["sandbox_session"]:
+        return None
+    try:
+        sandbox_session = SandboxSession(settings["sandbox_log_level"])
+    except (OSError, IOError) as err:
+        out.warn("the sandbox session could not be started: %s" % err)
+        session_failed = True
+    return sandbox_session
+
+@contextmanager
+def session():
+    '''Runs the sandboxed commands of the block in one sandboxed shell
+    if sandbox_session is enabled in the configuration'''
+    global sandbox_session, in_session
+    if in_session:
+        yield
+        return
+    in_session = True
+    try:
+        yield
+    finally:
+        in_session = False
+        if sandbox_session is not None:
+            sandbox_session.close()
+            sandbox_session = None
+
 
 def copytree(source, target, sym=True):
     if is_dir(source):
@@ -0,0 +1,195 @@
+# Copyright 2009 - 2011 Burak Sezer <purak@hadronproject.org>
+#
+# This file is part of lpms
+#
+# lpms is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# lpms is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with lpms.  If not, see <http://www.gnu.org/licenses/>.
+
+# A content addressed cache of directory trees. Every entry lives in
+# its own directory:
+#
+#   <cache dir>/<key>/tree    the cached tree
+#   <cache dir>/<key>/size    disk usage of the tree in bytes
+#
+# The modification time of the entry directory is its last use, the least
+# recently used entries are evicted when the cache grows over its limit.
+# The hits and misses of the lookups are counted in <cache dir>/.stats
+
+import os
+import json
+import shutil
+import tempfile
+import subprocess
+
+from lpms import out
+from lpms import utils
+
+class TreeCache(object):
+    # How the cached trees are copied to their targets
+    modes = {
+            'reflink': ('-a', '--reflink=auto'),
+            'hardlink': ('-al',),
+            'copy': ('-a',),
+    }
+
+    def __init__(self, directory, max_size=None, mode="reflink"):
+        '''max_size is given in megabytes, None means unlimited.
+        hardlink mode shares the inodes with the cache, so it is only used
+        for the targets that are populated as read only.'''
+        self.directory = directory
+        self.max_size = int(max_size)*1024*1024 if max_size else None
+        if mode not in self.modes:
+            out.warn("unknown cache mode: %s, using copy" % mode)
+            mode = "copy"
+        self.mode = mode
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def statistics(self):
+        '''Returns the hit and miss counts of the cache'''
+        try:
+            with open(os.path.join(self.directory, ".stats")) as stats_file:
+                return json.load(stats_file)
+        except (IOError, ValueError):
+            return {"hits": 0, "misses": 0}
+
+    def count(self, hit):
+        '''Records the result of a lookup'''
+        stats = self.statistics()
+        stats["hits" if hit else "misses"] += 1
+        path = os.path.join(self.directory, ".stats")
+        with open(path+".part", "w") as stats_file:
+            json.dump(stats, stats_file)
+        os.rename(path+".part", path)
+
+    def lookup(self, key):
+        '''Returns the cached tree for the key or None'''
+        tree = os.path.join(self.entry_path(key), "tree")
+        if not os.path.isdir(tree):
+            return None
+        os.utime(self.entry_path(key), None)
+        return tree
+
+    def stage(self):
+        '''Returns a new staging entry. Its tree directory should be filled
+        and the entry handed to publish or discard.'''
+        staging = tempfile.mkdtemp(prefix=".staging-", dir=self.directory)
+        os.mkdir(os.path.join(staging, "tree"))
+        return staging
+
+    def publish(self, staging, key):
+        '''Saves the staging entry under the key'''
+        with open(os.path.join(staging, "size"), "w") as size_file:
+            size_file.write(str(tree_size(os.path.join(staging, "tree"))))
+        try:
+            os.rename(staging, self.entry_path(key))
+        except OSError:
+            # another process has stored the same entry
+            self.discard(staging)
+        self.evict(keep=key)
+        return self.lookup(key)
+
+    def discard(self, staging):
+        if os.path.isdir(staging):
+            shutil.rmtree(staging)
+
+    def store(self, key, producer):
+        '''Calls producer with an empty directory and saves the result
+        under the key. A failed producer leaves the cache untouched.'''
+        staging = self.stage()
+        try:
+            producer(os.path.join(staging, "tree"))
+        except:
+            self.discard(staging)
+            raise
+        return self.publish(staging, key)
+
+    def populate(self, key, target, read_only=False):
+        '''Copies the cached tree into target. Returns False if the
+        entry does not exist or could not be copied. A target that is
+        going to be modified never shares its inodes with the cache.'''
+        tree = self.lookup(key)
+        if tree is None:
+            return False
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        mode = self.mode
+        if mode == "hardlink" and not read_only:
+            # a patch, strip or chmod would change the cached tree
+            mode = "reflink"
+        error = copy_tree(tree, target, self.modes[mode])
+        if error is not None:
+            out.warn("could not copy %s from the cache: %s" % (key, error))
+            return False
+        return True
+
+    def remove(self, key):
+        if os.path.isdir(self.entry_path(key)):
+            shutil.rmtree(self.entry_path(key))
+
+    def keys(self, prefix=""):
+        '''Returns the keys of the entries that start with prefix'''
+        return [key for key in os.listdir(self.directory) \
+                if not key.startswith(".") and key.startswith(prefix)]
+
+    def entries(self):
+        '''Returns (last use, size, key) tuples of the cache entries, oldest first'''
+        result = []
+        for key in os.listdir(self.directory):
+            if key.startswith("."):
+                continue
+            try:
+                with open(os.path.join(self.entry_path(key), "size")) as size_file:
+                    size = int(size_file.read())
+                result.append((os.stat(self.entry_path(key)).st_mtime, size, key))
+            except (IOError, OSError, ValueError):
+                continue
+        return sorted(result)
+
+    def evict(self, keep=None):
+        '''Removes the least recently used entries until the cache fits in its limit'''
+        if self.max_size is None:
+            return
+        entries = self.entries()
+        total = sum([size for last_use, size, key in entries])
+        for last_use, size, key in entries:
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            self.remove(key)
+            total -= size
+
+def copy_tree(source, target, arguments=TreeCache.modes['reflink']):
+    '''Copies the content of source into target. Returns the error message
+    of cp if it fails.'''
+    command = [utils.executable_path("cp")]+list(arguments)+[source+"/.", target]
+    result = subprocess.Popen(command, stderr=subprocess.PIPE)
+    error = result.communicate()[1]
+    if result.returncode != 0:
+        return error.strip()
+
+def tree_size(path):
+    '''Returns disk usage of the given tree in bytes, hardlinks are counted once'''
+    size = 0; inodes = set()
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            info = os.lstat(os.path.join(root, name))
+            if (info.st_dev, info.st_ino) in inodes:
+                continue
+            inodes.add((info.st_dev, info.st_ino))
+            size += info.st_blocks * 512
+    return size
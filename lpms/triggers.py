@@ -0,0 +1,190 @@
+# Copyright 2009 - 2011 Burak Sezer <purak@hadronproject.org>
+#
+# This file is part of lpms
+#
+# lpms is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# lpms is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with lpms.  If not, see <http://www.gnu.org/licenses/>.
+
+# Post-merge triggers. Merges enqueue the triggers that their files need,
+# and the triggers that a package declares in its spec:
+#
+#   triggers = ["ldconfig", "icon-cache"]
+#
+# The queue is run once at the end of the plan, so a global index is
+# rebuilt once no matter how many packages have touched it.
+
+import os
+import re
+import glob
+import subprocess
+import collections
+
+import lpms
+from lpms import out
+from lpms import utils
+from lpms import singleton
+from lpms import constants as cst
+
+# Shared libraries in these directories need a new linker cache
+library_path = re.compile(r"^/(usr/)?lib(32|64)?/[^/]*\.so(\.[0-9]+)*$")
+library_name = re.compile(r"^[^/]*\.so(\.[0-9]+)*$")
+# The configuration of the linker cache, a change in it needs a new cache too
+ldconfig_path = re.compile(r"^/etc/ld\.so\.conf(\.d/.*)?$")
+# Icons of a theme: /usr/share/icons/<theme>/...
+icon_path = re.compile(r"^/usr/share/icons/([^/]+)/.")
+
+def run(command):
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    if process.returncode != 0:
+        out.warn("command failed: %s" % out.color(" ".join(command), "red"))
+        if output:
+            out.write(output)
+        return False
+    return True
+
+class InfoTrigger(object):
+    '''Adds the merged info pages to the info directory'''
+    name = "info"
+
+    def detect(self, path, root):
+        if path.startswith("/"+cst.info+"/") and path.endswith(".gz"):
+            return path
+
+    def run(self, root, items):
+        if not os.access("/usr/bin/install-info", os.X_OK):
+            out.error("/usr/bin/install-info seems broken. please check sys-apps/texinfo")
+            return
+        dir_path = os.path.join(root, cst.info, "dir")
+        for item in items:
+            info_file = os.path.join(root, item[1:])
+            if item != "*" and os.path.exists(info_file):
+                utils.update_info_index(info_file, dir_path=dir_path)
+
+class LdconfigTrigger(object):
+    '''Updates the shared library cache of the root'''
+    name = "ldconfig"
+
+    def __init__(self):
+        # root -> the directories that are listed in its ld.so.conf
+        self.directories = {}
+
+    def library_directories(self, root):
+        '''Reads the directories of ld.so.conf and the files it includes'''
+        if root in self.directories:
+            return self.directories[root]
+        directories = set()
+        def parse(path, seen):
+            if path in seen or not os.path.isfile(path):
+                return
+            seen.add(path)
+            with open(path) as conf_file:
+                for line in conf_file:
+                    line = line.split("#", 1)[0].strip()
+                    if not line or line.startswith("hwcap"):
+                        continue
+                    if line.startswith("include"):
+                        for pattern in line.split()[1:]:
+                            if not pattern.startswith("/"):
+                                pattern = os.path.join("/etc", pattern)
+                            for included in sorted(glob.glob(os.path.join(root, pattern[1:]))):
+                                parse(included, seen)
+                        continue
+                    for directory in re.split(r"[\s:,=]+", line):
+                        if directory.startswith("/"):
+                            directories.add(os.path.normpath(directory))
+        parse(os.path.join(root, "etc/ld.so.conf"), set())
+        self.directories[root] = directories
+        return directories
+
+    def detect(self, path, root):
+        if library_path.match(path) or ldconfig_path.match(path):
+            return path
+        if library_name.match(os.path.basename(path)) and \
+                os.path.dirname(path) in self.library_directories(root):
+            return path
+
+    def run(self, root, items):
+        ldconfig = utils.executable_path("ldconfig")
+        if ldconfig is None:
+            out.warn("ldconfig could not be found, the library cache is not updated.")
+            return
+        run([ldconfig] if root == cst.root else [ldconfig, "-r", root])
+
+class IconCacheTrigger(object):
+    '''Updates the icon caches of the themes that have new icons'''
+    name = "icon-cache"
+
+    def detect(self, path, root):
+        result = icon_path.match(path)
+        if result is not None:
+            return result.group(1)
+
+    def run(self, root, items):
+        command = utils.executable_path("gtk-update-icon-cache")
+        if command is None:
+            return
+        icons = os.path.join(root, "usr/share/icons")
+        if "*" in items and os.path.isdir(icons):
+            items = os.listdir(icons)
+        for theme in items:
+            theme_dir = os.path.join(icons, theme)
+            if os.path.isfile(os.path.join(theme_dir, "index.theme")):
+                run([command, "-q", "-t", "-f", theme_dir])
+
+available = dict([(trigger.name, trigger()) for trigger in \
+        (InfoTrigger, LdconfigTrigger, IconCacheTrigger)])
+
+class TriggerQueue(object):
+    '''Collects the triggers of the merged packages'''
+    __metaclass__ = singleton.Singleton
+
+    def __init__(self):
+        # (root, trigger name) -> items of the trigger, in merge order
+        self.queue = {}
+        self.order = []
+
+    def add(self, root, name, item="*"):
+        if not name in available:
+            out.warn("unknown trigger: %s" % name)
+            return
+        key = (root, name)
+        if not key in self.queue:
+            self.queue[key] = collections.OrderedDict()
+            self.order.append(key)
+        self.queue[key][item] = True
+
+    def add_package(self, environment, paths):
+        '''Enqueues the triggers of a merged package. paths are the merged
+        files and links, relative to the root.'''
+        root = environment.real_root
+        declared = environment.triggers
+        if isinstance(declared, basestring):
+            declared = declared.split()
+        for name in declared or []:
+            self.add(root, name)
+        for path in paths:
+            for trigger in available.values():
+                item = trigger.detect(path, root)
+                if item is not None:
+                    self.add(root, trigger.name, item)
+
+    def run(self):
+        '''Runs every queued trigger once'''
+        for root, name in self.order:
+            items = self.queue[(root, name)].keys()
+            out.normal("running %s trigger" % name)
+            lpms.logger.info("running %s trigger for %d item(s) in %s" % (name, len(items), root))
+            available[name].run(root, items)
+        self.queue = {}
+        self.order = []
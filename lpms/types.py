@@ -15,6 +15,9 @@
 # You should have received a copy of the GNU General Public License
 # along with lpms.  If not, see <http://www.gnu.org/licenses/>.
 
+import re
+import fnmatch
+
 from lpms.exceptions import ItemNotFound
 
 class LCollect(object):
@@ -45,6 +48,70 @@ class LCollect(object):
     def raw(self):
         return self.__dict__
 
+class PathTree(object):
+    '''A trie of path components. It answers whether one of the added
+    directories is a parent of a path, in steps of the path depth.'''
+    def __init__(self, paths=()):
+        self.root = {}
+        self.length = 0
+        for path in paths:
+            self.add(path)
+
+    def add(self, path):
+        node = self.root
+        for component in path.split("/"):
+            if component:
+                node = node.setdefault(component, {})
+        if not None in node:
+            node[None] = True
+            self.length += 1
+
+    def has_parent(self, path):
+        '''Returns True if an added directory is a parent of the path.
+        The directory itself is not its own parent.'''
+        node = self.root
+        for component in path.split("/"):
+            if not component:
+                continue
+            if None in node:
+                return True
+            node = node.get(component)
+            if node is None:
+                return False
+        return False
+
+    def __len__(self):
+        return self.length
+
+class PathMatcher(object):
+    '''Matches paths against a list of rules. A plain rule matches the path
+    itself and everything below it, a rule with wildcards is matched against
+    the whole path like a shell glob.'''
+    glob_chars = re.compile(r"[*?[]")
+
+    def __init__(self, rules=()):
+        self.paths = set()
+        self.directories = PathTree()
+        globs = []
+        for rule in rules:
+            rule = rule.strip()
+            if not rule or rule.startswith("#"):
+                continue
+            if self.glob_chars.search(rule):
+                globs.append("(?:%s)" % fnmatch.translate(rule))
+            else:
+                rule = rule.rstrip("/") or "/"
+                self.paths.add(rule)
+                self.directories.add(rule)
+        self.globs = re.compile("|".join(globs)).match if globs else None
+
+    def match(self, path):
+        return path in self.paths or self.directories.has_parent(path) or \
+                (self.globs is not None and self.globs(path) is not None)
+
+    def __len__(self):
+        return len(self.paths) + (1 if self.globs is not None else 0)
+
 class PackageItem(list):
     def get(self, index):
         return self[index]
@@ -32,6 +32,7 @@ from lpms import conf
 from lpms import shelltools
 from lpms import constants as cst
 
+from lpms.types import PathMatcher
 from lpms.exceptions import LockedPackage
 from lpms.exceptions import UnavailablePackage
 
@@ -342,9 +343,22 @@ def update_info_index(info_path, dir_path="/usr/share/info/dir", delete=False):
         return False
     return True
 
+def reserve_files_matcher(reserve_files=None):
+    '''Compiles the reserve_files of a package and the rules in the user's
+    reserve files into a PathMatcher'''
+    rules = []
+    if isinstance(reserve_files, basestring):
+        rules.extend(reserve_files.split(" "))
+    elif isinstance(reserve_files, (list, tuple)):
+        rules.extend(reserve_files)
+    protect_file = os.path.join(cst.user_dir, cst.protect_file)
+    if os.path.isfile(protect_file):
+        with open(protect_file) as data:
+            rules.extend(data.readlines())
+    return PathMatcher(rules)
+
 def check_cflags(flag):
-    return flag in [atom.strip() for \
-            atom in conf.LPMSConfig().CFLAGS.strip(" ")]
+    return flag in conf.LPMSConfig().CFLAGS.split()
 
 def set_parser(set_name):
     sets = []
@@ -468,12 +482,6 @@ def get_mimetype(path):
     file_obj.close()
     return mimetype
 
-def run_strip(path):
-    p = os.popen("/usr/bin/strip --strip-unneeded %s" % path)
-    ret = p.close()
-    if ret:
-        out.warn("/usr/bin/strip/ --strip-unneeded command failed for %s" % path)
-
 def confirm(text):
     turns = 5
     while turns:
@@ -622,15 +630,43 @@ def get_mtime(path):
 def get_atime(path):
     return os.stat(path)[stat.ST_ATIME]
 
-def sha1sum(path):
+def sha1sum(path, chunk_size=1024*1024):
+    sh = hashlib.sha1()
     try:
-        buf = open(path).read()
+        with open(path, "rb") as myfile:
+            while True:
+                buf = myfile.read(chunk_size)
+                if not buf:
+                    break
+                sh.update(buf)
     except:
         return False
-    sh = hashlib.sha1()
-    sh.update(buf)
     return sh.hexdigest()
 
+def digest_algorithms():
+    '''Returns the digests written to hashes files, sha1 always comes first'''
+    algorithms = ['sha1', 'sha256']
+    if hasattr(hashlib, "blake2b"):
+        algorithms.append('blake2b')
+    return algorithms
+
+def file_digests(path, algorithms=None, chunk_size=1024*1024):
+    '''Calculates several digests of the file in a single read.
+    Returns the size of the file and a list of (algorithm, digest) pairs.'''
+    if algorithms is None:
+        algorithms = digest_algorithms()
+    hashers = [(algorithm, getattr(hashlib, algorithm)()) for algorithm in algorithms]
+    size = 0
+    with open(path, "rb") as myfile:
+        while True:
+            buf = myfile.read(chunk_size)
+            if not buf:
+                break
+            size += len(buf)
+            for algorithm, hasher in hashers:
+                hasher.update(buf)
+    return size, [(algorithm, hasher.hexdigest()) for algorithm, hasher in hashers]
+
 # FIXME:
 def get_src_url(metadata, name, version):
     for tag in ('src_url', 'src_repository'):
@@ -17,9 +17,12 @@
 
 from lpms import utils
 from lpms import out
+from lpms import schedule
 
-def show(packages, conflicts, options, installdb):
-    '''Shows operation summary to the user'''
+def show(packages, conflicts, options, installdb, binaries=None, estimates=None):
+    '''Shows operation summary to the user. The packages that are
+    installed from binary packages are marked with B. estimates are
+    the durations that are expected from the build history.'''
     # TODO: This can be splitted as a module
     for package in packages:
         status_bar = [' ', '  ']
@@ -50,6 +53,8 @@ def show(packages, conflicts, options, installdb):
                                         installed_package.version, "green")
                         elif package.version == installed_package.version:
                             status_bar[0] = out.color("R", "brightyellow")
+        if binaries is not None:
+            status_bar.append(out.color("B", "brightblue") if package.id in binaries else " ")
 
         class FormattedOptions(list):
             def __init__(self, data):
@@ -97,7 +102,11 @@ def show(packages, conflicts, options, installdb):
                 formatted_options = [out.color("%"+applied_option, "brightyellow") \
                         for applied_option in installed_package.applied_options]
 
-        out.write("  [%s] %s/%s/%s {%s:%s} {%s} %s%s\n" % (
+        estimate = ""
+        if estimates is not None:
+            estimate = " ~"+schedule.format_duration(estimates[package.id]) \
+                    if estimates.get(package.id) is not None else " ~?"
+        out.write("  [%s] %s/%s/%s {%s:%s} {%s} %s%s%s\n" % (
                 " ".join(status_bar), \
                 package.repo, \
                 package.category, \
@@ -106,7 +115,8 @@ def show(packages, conflicts, options, installdb):
                 out.color(package.version, "green"),\
                 package.arch, \
                 other_version, \
-                " ("+", ".join(formatted_options)+")" if formatted_options else ""
+                " ("+", ".join(formatted_options)+")" if formatted_options else "",
+                out.color(estimate, "brightcyan") if estimate else ""
                 )
         )
         
@@ -123,3 +133,10 @@ def show(packages, conflicts, options, installdb):
                             conflict.version
                     ))
 
+def show_estimate(packages, estimates):
+    '''Shows the total duration of the plan'''
+    unknown = len([package for package in packages if estimates.get(package.id) is None])
+    total = sum([estimates[package.id] for package in packages \
+            if estimates.get(package.id) is not None])
+    out.write("estimated time: %s%s\n" % (out.color(schedule.format_duration(total), "green"), \
+            " (%d package(s) have no build history)" % unknown if unknown else ""))
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# Copyright 2009 - 2011 Burak Sezer <purak@hadronproject.org>
+#
+# This file is part of lpms
+#
+# lpms is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# lpms is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with lpms.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compares the streaming extractor with the old extraction code.
+# Every run is forked, so wall time and peak memory of each method
+# are measured separately.
+#
+# usage: benchmark_extract.py [--partial pattern ...] archive [archive ...]
+
+import os
+import sys
+import time
+import gzip
+import shutil
+import tarfile
+import tempfile
+import subprocess
+
+from lpms import out
+from lpms import utils
+from lpms import archive
+
+def legacy_extract(path, location, partial=False):
+    '''The extraction code as it was before the streaming pipeline'''
+    if isinstance(partial, list):
+        myarchive = tarfile.open(path, 'r')
+        for name in myarchive.getnames():
+            if name in partial:
+                myarchive.extract(name, path=location)
+            else:
+                for item in partial:
+                    if len(name.split(item, 1)) == 2:
+                        myarchive.extract(name, path=location)
+        myarchive.close()
+    elif path.endswith(".lzma") or path.endswith(".xz"):
+        current = os.getcwd()
+        os.chdir(location)
+        cmd = utils.executable_path("tar") + " --lzma xvf %s" % path
+        if path.endswith(".xz"):
+            cmd = utils.executable_path("tar") + " Jxvf %s" % path
+        result = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        result.communicate()
+        os.chdir(current)
+    elif path.endswith(".gz") and not (path.endswith(".tar.gz")):
+        with gzip.open(path, "rb") as compressed:
+            content = compressed.read()
+            with open(os.path.join(location, os.path.basename(path)[:-3]), "w+") as myfile:
+                myfile.write(content)
+    else:
+        myarchive = tarfile.open(path, 'r')
+        myarchive.extractall(location)
+        myarchive.close()
+
+def streaming_extract(path, location, partial=False):
+    archive.extract(path, location, partial)
+
+def list_tree(location):
+    result = set()
+    for root, dirs, files in os.walk(location):
+        for item in dirs + files:
+            result.add(os.path.relpath(os.path.join(root, item), location))
+    return result
+
+def measure(method, path, partial):
+    location = tempfile.mkdtemp(prefix="lpms-benchmark-")
+    try:
+        start = time.time()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                method(path, location, partial)
+            except:
+                os._exit(1)
+            os._exit(0)
+        pid, status, usage = os.wait4(pid, 0)
+        return time.time() - start, usage.ru_maxrss, status, list_tree(location)
+    finally:
+        shutil.rmtree(location)
+
+def main(args):
+    partial = False
+    paths = []
+    while args:
+        arg = args.pop(0)
+        if arg == "--partial" and args:
+            if not partial:
+                partial = []
+            partial.append(args.pop(0))
+        else:
+            paths.append(arg)
+    if not paths:
+        out.error("usage: %s [--partial pattern ...] archive [archive ...]" % \
+                os.path.basename(sys.argv[0]))
+        sys.exit(1)
+    for path in paths:
+        path = os.path.abspath(path)
+        out.normal("%s (%d bytes)" % (os.path.basename(path), os.path.getsize(path)))
+        results = {}; trees = {}
+        for name, method in (("legacy", legacy_extract), ("streaming", streaming_extract)):
+            wall, maxrss, status, trees[name] = measure(method, path, partial)
+            if status != 0:
+                out.warn("%s extraction failed" % name)
+                continue
+            results[name] = wall
+            out.write("    %-10s %8.2fs  %8d KiB max rss\n" % (name, wall, maxrss))
+        if len(results) == 2 and results["streaming"]:
+            out.write("    speedup: %.2fx\n" % (results["legacy"] / results["streaming"]))
+        if trees["legacy"] != trees["streaming"]:
+            out.warn("extracted trees differ: %d entries vs %d entries" % \
+                    (len(trees["legacy"]), len(trees["streaming"])))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
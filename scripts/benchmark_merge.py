@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# Copyright 2009 - 2011 Burak Sezer <purak@hadronproject.org>
+#
+# This file is part of lpms
+#
+# lpms is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# lpms is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with lpms.  If not, see <http://www.gnu.org/licenses/>.
+
+# Merges a generated package into a temporary root and reports how many
+# bytes were hashed for every merged byte.
+#
+# usage: benchmark_merge.py [--files N] [--size KB] [--root DIR] [--build DIR]
+#
+# Give --root and --build on different filesystems to measure the copy path.
+
+import os
+import sys
+import time
+import shutil
+import hashlib
+import tempfile
+
+def option(name, default):
+    if name in sys.argv:
+        return sys.argv[sys.argv.index(name)+1]
+    return default
+
+files_count = int(option("--files", 2000))
+file_size = int(option("--size", 64))*1024
+root = tempfile.mkdtemp(prefix="lpms-root-", dir=option("--root", None))
+build = tempfile.mkdtemp(prefix="lpms-build-", dir=option("--build", None))
+
+# The databases are created in the temporary root
+sys.argv = [sys.argv[0], "--change-root=%s" % root]
+
+from lpms import out
+from lpms import internals
+from lpms.operations import merge
+
+hashed_bytes = [0]
+sha1 = hashlib.sha1
+
+class CountingHash(object):
+    def __init__(self, data=""):
+        self.hasher = sha1()
+        self.update(data)
+
+    def update(self, data):
+        hashed_bytes[0] += len(data)
+        self.hasher.update(data)
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+def prepare(install_dir):
+    merged = 0
+    for index in range(files_count):
+        directory = os.path.join(install_dir, "usr/share/benchmark/%d" % (index / 100))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, "file%d" % index), "wb") as myfile:
+            myfile.write(os.urandom(file_size))
+        merged += file_size
+    return merged
+
+def main():
+    environment = internals.Environment()
+    environment.repo = "benchmark"
+    environment.category = "app-benchmark"
+    environment.name = "merge"
+    environment.version = "1.0"
+    environment.slot = "0"
+    environment.real_root = root
+    environment.install_dir = os.path.join(build, "install")
+    try:
+        merged = prepare(environment.install_dir)
+        hashlib.sha1 = CountingHash
+        start = time.time()
+        merge.Merge(environment).merge_package()
+        elapsed = time.time() - start
+        out.normal("%d files, %d bytes merged in %.2fs" % (files_count, merged, elapsed))
+        out.write("    bytes hashed per merged byte: %.2f\n" % (float(hashed_bytes[0]) / merged))
+    finally:
+        shutil.rmtree(root)
+        shutil.rmtree(build)
+
+if __name__ == "__main__":
+    main()
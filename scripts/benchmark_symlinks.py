@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# Copyright 2009 - 2011 Burak Sezer <purak@hadronproject.org>
+#
+# This file is part of lpms
+#
+# lpms is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# lpms is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with lpms.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compares the symlinked parent lookup of merge and collision scanning
+# with the list scan that was used before.
+#
+# usage: benchmark_symlinks.py [--symlinks N] [--paths N]
+
+import sys
+import time
+import random
+
+from lpms import out
+from lpms.types import PathTree
+
+def option(name, default):
+    if name in sys.argv:
+        return int(sys.argv[sys.argv.index(name)+1])
+    return default
+
+def list_scan(symlinks, path):
+    '''The lookup as it was before PathTree'''
+    for symlink in symlinks:
+        if path.startswith(symlink):
+            return True
+
+def main():
+    symlinks_count = option("--symlinks", 2000)
+    paths_count = option("--paths", 50000)
+    random.seed(0)
+    symlinks = ["/usr/lib/compat%d/" % index for index in range(symlinks_count)]
+    paths = ["/usr/lib/compat%d/file%d" % (random.randrange(symlinks_count*2), index) \
+            for index in range(paths_count)]
+
+    start = time.time()
+    tree = PathTree(symlinks)
+    tree_results = [tree.has_parent(path) for path in paths]
+    tree_time = time.time() - start
+
+    start = time.time()
+    list_results = [bool(list_scan(symlinks, path)) for path in paths]
+    list_time = time.time() - start
+
+    out.normal("%d symlinked directories, %d paths" % (symlinks_count, paths_count))
+    out.write("    %-10s %8.3fs\n" % ("list", list_time))
+    out.write("    %-10s %8.3fs\n" % ("tree", tree_time))
+    if tree_time:
+        out.write("    speedup: %.2fx\n" % (list_time / tree_time))
+    if tree_results != list_results:
+        out.warn("the results differ")
+
+if __name__ == "__main__":
+    main()
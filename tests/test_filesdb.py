@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+import shutil
+import tempfile
+import unittest
+
+from lpms.db import base
+from lpms.db import filesdb
+
+class GetOwnersByPathsTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="lpms-filesdb-")
+        base.use_root(self.root)
+        self.database = filesdb.FilesDatabase()
+
+    def tearDown(self):
+        self.database.connection.close()
+        base.use_root(None)
+        shutil.rmtree(self.root)
+
+    def add_file(self, path):
+        self.database.append_query(("main", "sys-apps", "foo", "1.0", path, "file", \
+                10, 0, 0o644, 0, "sha1", path, "0"))
+        self.database.insert_query(commit=True)
+
+    def test_non_ascii_path(self):
+        path = "/usr/share/foo/caf\xc3\xa9.txt"
+        self.add_file(path)
+        self.add_file("/usr/share/foo/plain.txt")
+        result = self.database.get_owners_by_paths([path, "/usr/share/foo/missing"])
+        self.assertEqual(result, [(path, "sys-apps", "foo", "0", "1.0")])
+        self.assertTrue(isinstance(result[0][0], str))
+
+    def test_unicode_path(self):
+        self.add_file("/usr/share/foo/plain.txt")
+        result = self.database.get_owners_by_paths([u"/usr/share/foo/plain.txt"])
+        self.assertEqual([item[0] for item in result], [u"/usr/share/foo/plain.txt"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+from lpms import internals
+from lpms.db import base
+from lpms.operations import merge
+
+class SymlinkedDirectoryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="lpms-merge-")
+        self.root = os.path.join(self.directory, "root")
+        self.install_dir = os.path.join(self.directory, "install")
+        os.makedirs(os.path.join(self.root, "var/db/lpms"))
+        os.makedirs(os.path.join(self.install_dir, "usr/lib64"))
+        with open(os.path.join(self.install_dir, "usr/lib64/libfoo.so"), "w") as library:
+            library.write("foo")
+        os.symlink("lib64", os.path.join(self.install_dir, "usr/lib"))
+        # the repository database follows --change-root
+        self.argv = sys.argv[:]
+        sys.argv.append("--change-root=%s" % self.root)
+        base.use_root(self.root)
+        self.inspected = []
+        self.inspect_file = merge.inspect_file
+        def inspect_file(source, **kwargs):
+            self.inspected.append(source)
+            return self.inspect_file(source, **kwargs)
+        merge.inspect_file = inspect_file
+
+    def tearDown(self):
+        merge.inspect_file = self.inspect_file
+        base.use_root(None)
+        sys.argv[:] = self.argv
+        shutil.rmtree(self.directory)
+
+    def test_symlinked_lib_directory(self):
+        environment = internals.Environment()
+        for key, value in (("repo", "main"), ("category", "sys-libs"), ("name", "foo"), \
+                ("version", "1.0"), ("slot", "0"), ("real_root", self.root), \
+                ("install_dir", self.install_dir)):
+            setattr(environment, key, value)
+        operation = merge.Merge(environment)
+        operation.merge_package()
+        operation.filesdb.commit()
+        operation.journal.finish()
+
+        self.assertEqual(self.inspected, [os.path.join(self.install_dir, "usr/lib64/libfoo.so")])
+        self.assertEqual(os.readlink(os.path.join(self.root, "usr/lib")), "lib64")
+        with open(os.path.join(self.root, "usr/lib64/libfoo.so")) as library:
+            self.assertEqual(library.read(), "foo")
+        paths = sorted([item[0] for item in operation.filesdb.get_paths_by_package("foo", \
+                category="sys-libs", version="1.0")])
+        self.assertEqual(paths, [u"/usr", u"/usr/lib", u"/usr/lib64", u"/usr/lib64/libfoo.so"])
+
+if __name__ == "__main__":
+    unittest.main()